@@ -1,14 +1,17 @@
+import asyncio
 import io
 import re
 from enum import Enum
 
-from nonebot import on_command, on_message
+from nonebot import logger, on_command, on_message
 from nonebot.adapters.onebot.v11 import MessageEvent
 from nonebot.internal.matcher import Matcher
 from nonebot.params import CommandArg
 from nonebot.rule import startswith
 
-from .gallery import gallery_manager, Gallery, ImageMeta, get_random_image, get_all_image, GalleryFilter
+from .data import run_db
+from .gallery import gallery_manager, Gallery, ImageMeta, get_random_image, get_all_image, GalleryFilter, PhashWrapper
+from .image_worker import load_thumbnails, load_thumbnails_of, enqueue_thumbnail
 from .message_builder import MessageBuilder, ForwardMessageBuilder
 from .plot import *
 from .utils import get_images_from_context, download_images, CachedFile, ArgParser
@@ -18,6 +21,12 @@ kan_command = on_command("看", priority=8)
 shangchuan_command = on_command("上传", priority=8)
 upload_command = on_command("upload", force_whitespace=True, priority=5)
 
+# 同时下载、计算指纹和查重的图片数
+UPLOAD_PIPELINE_CONCURRENCY = 8
+# 一次上传的图片较多时先回复一条提示，之后每隔一段时间 (秒) 报告进度
+UPLOAD_PROGRESS_THRESHOLD = 20
+UPLOAD_PROGRESS_INTERVAL = 15
+
 
 @gall_command.handle()
 async def _(event: MessageEvent, matcher: Matcher, args=CommandArg()):
@@ -118,11 +127,11 @@ async def add_gallery(event: MessageEvent, params: str, matcher: Matcher):
         return await reply_help(event, matcher)
 
     exist_names = [name for name in gallery_names if
-                   gallery_manager.check_exists(name) or gallery_manager.check_filter_exists(name)]
+                   gallery_manager.check_exists(name) or await run_db(gallery_manager.check_filter_exists, name)]
     if len(exist_names) > 0:
         return await MessageBuilder().text(f"画廊 {', '.join(exist_names)} 已存在").reply_to(event).send(matcher)
     else:
-        gallery_manager.add_gallery(gallery_names)
+        await run_db(gallery_manager.add_gallery, gallery_names)
         return await MessageBuilder().text(f"成功创建画廊 {params}").reply_to(event).send(matcher)
 
 
@@ -132,8 +141,8 @@ async def clear_gallery(event: MessageEvent, params: str, matcher: Matcher):
     if gallery_name is None:
         return await reply_help(event, matcher)
     gallery: Gallery = gallery_manager.find_gallery(gallery_name)
-    for image in gallery.list_images():
-        image.drop()
+    for image in await run_db(gallery.list_images):
+        await run_db(image.drop)
     return await MessageBuilder().text(f"已清空画廊 {gallery_name} 中的所有图片").reply_to(event).send(matcher)
 
 
@@ -159,7 +168,7 @@ async def modify_gallery(event: MessageEvent, params: str, matcher: Matcher):
             if del_name in names:
                 names.remove(del_name)
 
-    gallery.update_name()
+    await run_db(gallery.update_name)
     return await MessageBuilder().text(f"已修改画廊名称为：{' '.join(gallery.name)}").reply_to(event).send(matcher)
 
 
@@ -172,7 +181,7 @@ async def remove_gallery(event: MessageEvent, params: str, matcher: Matcher):
     if not gallery:
         return await MessageBuilder().text(f"没有找到画廊 {gallery_name}").reply_to(event).send(matcher)
 
-    gallery.drop()
+    await run_db(gallery.drop)
     return await MessageBuilder().text(f"已删除画廊 {gallery_name}").reply_to(event).send(matcher)
 
 
@@ -183,7 +192,8 @@ async def list_galleries(event: MessageEvent, _param: str, matcher: Matcher):
     message_builder = MessageBuilder()
     message_builder.text(f"当前画廊列表({len(galleries)})：")
     for gallery in galleries:
-        message_builder.text(f"- (#{gallery.id}){' / '.join(gallery.name)} (图片数量: {gallery.count_images()})")
+        count = await run_db(gallery.count_images)
+        message_builder.text(f"- (#{gallery.id}){' / '.join(gallery.name)} (图片数量: {count})")
     return await ForwardMessageBuilder().node(message_builder).send(matcher)
 
 
@@ -214,7 +224,7 @@ async def add_image(event: MessageEvent, params: str, matcher: Matcher):
         case "replace" | "替换":
             mode = Mode.REPLACE
             args.pop()
-    filters = gallery_manager.get_filters(gallery_name)
+    filters = await run_db(gallery_manager.get_filters, gallery_name)
     gallery: Gallery = gallery_manager.find_gallery(filters.gallery)
 
     if not gallery:
@@ -297,38 +307,88 @@ async def add_image(event: MessageEvent, params: str, matcher: Matcher):
         message_builder.text("tips：备注包含空格或关键字请使用如\" -- comment\"")
         return await message_builder.send(matcher)
 
-    images = await get_images_from_context(event)
+    images, truncated = await get_images_from_context(event)
     if len(images) == 0:
         return await MessageBuilder().text(f"没有找到图片").reply_to(event).send(matcher)
-    image_files = await download_images(images)
-    all_image_files = [img for img in image_files]
 
+    pipeline_semaphore = asyncio.Semaphore(UPLOAD_PIPELINE_CONCURRENCY)
+
+    processed_count = 0
+
+    async def prepare(image: Tuple[str, Optional[str]]) -> Tuple[CachedFile, Optional[int], list[ImageMeta]]:
+        """下载、计算指纹并查重，各图片并发执行"""
+        nonlocal processed_count
+        async with pipeline_semaphore:
+            try:
+                image_file = (await download_images([image]))[0]
+                phash = await image_file.ensure_fingerprint()
+                sames = []
+                if mode != Mode.FORCE and phash is not None:
+                    sames = await run_db(gallery.find_same_phash, PhashWrapper(phash))
+                return image_file, phash, sames
+            finally:
+                processed_count += 1
+
+    async def report_progress():
+        while True:
+            await asyncio.sleep(UPLOAD_PROGRESS_INTERVAL)
+            await MessageBuilder().text(f"已处理 {processed_count}/{len(images)} 张图片……").reply_to(event).send(matcher)
+
+    progress_task = None
+    if len(images) >= UPLOAD_PROGRESS_THRESHOLD:
+        await MessageBuilder().text(f"共 {len(images)} 张图片，正在处理……").reply_to(event).send(matcher)
+        progress_task = asyncio.create_task(report_progress())
+
+    all_image_files: list[CachedFile] = []
+    image_files: list[CachedFile] = []
     existing_images: list[Tuple[CachedFile, list[ImageMeta]]] = []
     replaced_images: list[Tuple[CachedFile, ImageMeta]] = []
-    replaced_indexes: list[int] = []
     replaced_images2: list[Tuple[ImageMeta, ImageMeta]] = []
-    if mode != Mode.FORCE:
-        for i, image in enumerate(image_files):
-            sames = gallery.find_same_image(image.local_path)
-            if sames and len(sames) > 0:
-                if mode == Mode.REPLACE:
-                    replaced_images.append((image, sames[0]))
-                    replaced_indexes.append(i)
-                else:
-                    existing_images.append((image, sames))
-
-        existing_image_files = [image for image, _ in existing_images]
-        image_files = [image for image in image_files if image not in existing_image_files]
-
+    failed_count = 0
+    added_ids = set()
     image_obj = None
-    for i, image in enumerate(image_files):
-        image_obj = gallery.add_image_unchecked(image.local_path, filters.comment, filters.tags, str(event.user_id),
-                                                file_id=image.extra.get("file_id"))
-        if i in replaced_indexes:
-            replaced_images2.append((image_obj, replaced_images[replaced_indexes.index(i)][1]))
-
-    if len(all_image_files) > 0:
-        message_builder.text(f"成功添加 {len(image_files)}/{len(all_image_files)} 张图片到画廊 {filters.gallery}。")
+    # 下载、指纹和查重并发进行，入库按消息中的顺序依次执行，新图片 id 的顺序与消息一致
+    tasks = [asyncio.create_task(prepare(image)) for image in images]
+    try:
+        for task in tasks:
+            try:
+                image, phash, sames = await task
+            except Exception as e:
+                logger.warning(f"处理上传图片失败: {e}")
+                failed_count += 1
+                continue
+            if phash is None:
+                # 无法解码的图片不入库，否则 add_image_unchecked 会在数据库线程里重新计算指纹并抛出异常
+                logger.warning(f"无法计算上传图片的指纹: {image.local_path}")
+                failed_count += 1
+                continue
+            all_image_files.append(image)
+            # 只和上传前已有的图片查重，与一次性查重再入库的结果一致
+            sames = [same for same in sames if same.id not in added_ids]
+            if sames and mode != Mode.REPLACE:
+                existing_images.append((image, sames))
+                continue
+            image_obj = await run_db(gallery.add_image_unchecked, image.local_path, filters.comment, filters.tags,
+                                     str(event.user_id), file_id=image.extra.get("file_id"),
+                                     phash=PhashWrapper(phash))
+            added_ids.add(image_obj.id)
+            enqueue_thumbnail(image_obj)
+            image_files.append(image)
+            if sames:
+                replaced_images.append((image, sames[0]))
+                replaced_images2.append((image_obj, sames[0]))
+    finally:
+        for task in tasks:
+            task.cancel()
+        if progress_task is not None:
+            progress_task.cancel()
+
+    if len(images) > 0:
+        message_builder.text(f"成功添加 {len(image_files)}/{len(images)} 张图片到画廊 {filters.gallery}。")
+    if truncated:
+        message_builder.text(truncated)
+    if failed_count > 0:
+        message_builder.text(f"{failed_count} 张图片下载或处理失败。")
     if len(image_files) == 1:
         message_builder.text(f"新图片ID：{image_obj.id}。")
     if len(filters.tags) > 0:
@@ -343,20 +403,19 @@ async def add_image(event: MessageEvent, params: str, matcher: Matcher):
 
         canvas_items: List[Tuple[Image, Image, str, str]] = []
 
-        for image, sames in existing_images:
-            img = Image.open(image.local_path)
-            img.thumbnail(gallery_config.repeat_image_show_size)
-            pic = sames[0]
-            img2 = pic.get_image()
-            img2.thumbnail(gallery_config.repeat_image_show_size)
-            canvas_items.append((img, img2, "待上传图片", f"id: {pic.id}"))
-
-        for pic_added, pic_exist in replaced_images2:
-            img = pic_added.get_image()
-            img.thumbnail(gallery_config.repeat_image_show_size)
-            img2 = pic_exist.get_image()
-            img2.thumbnail(gallery_config.repeat_image_show_size)
-            canvas_items.append((img, img2, f"已上传id: {pic_added.id}", f"被替换id: {pic_exist.id}"))
+        # 待上传的图片只能读原图，画廊中的图片使用缩略图金字塔
+        show_size = gallery_config.repeat_image_show_size
+        uploaded_thumbs, existing_thumbs, replaced_thumbs = await asyncio.gather(
+            load_thumbnails([image.local_path for image, _ in existing_images], show_size),
+            load_thumbnails_of([sames[0] for _, sames in existing_images], show_size),
+            load_thumbnails_of([image for pair in replaced_images2 for image in pair], show_size))
+
+        for i, (image, sames) in enumerate(existing_images):
+            canvas_items.append((uploaded_thumbs[i], existing_thumbs[i], "待上传图片", f"id: {sames[0].id}"))
+
+        for i, (pic_added, pic_exist) in enumerate(replaced_images2):
+            canvas_items.append((replaced_thumbs[2 * i], replaced_thumbs[2 * i + 1], f"已上传id: {pic_added.id}",
+                                 f"被替换id: {pic_exist.id}"))
 
         with Canvas(bg=FillBg((230, 240, 255, 255))).set_padding(8) as canvas:
             with VSplit().set_padding(0).set_sep(16).set_item_align('lt').set_content_align('lt'):
@@ -367,8 +426,12 @@ async def add_image(event: MessageEvent, params: str, matcher: Matcher):
                     for image, same, text1, text2 in canvas_items:
                         with HSplit().set_padding(0).set_sep(4):
                             with VSplit().set_padding(0).set_sep(4).set_content_align('c').set_item_align('c'):
-                                ImageBox(image=image, size=gallery_config.repeat_image_show_size,
-                                         image_size_mode='fit').set_content_align('c')
+                                if image:
+                                    ImageBox(image=image, size=gallery_config.repeat_image_show_size,
+                                             image_size_mode='fit').set_content_align('c')
+                                else:
+                                    Spacer(w=gallery_config.repeat_image_show_size[0],
+                                           h=gallery_config.repeat_image_show_size[1])
                                 TextBox(text1, TextStyle(DEFAULT_FONT, 16, BLACK))
                             with VSplit().set_padding(0).set_sep(4).set_content_align('c').set_item_align('c'):
                                 if same:
@@ -383,7 +446,7 @@ async def add_image(event: MessageEvent, params: str, matcher: Matcher):
         repeat_img.save(file, format="PNG")
         message_builder.image(file)
     for _, image in replaced_images:
-        image.drop()
+        await run_db(image.drop)
     await message_builder.send(matcher)
     for image in all_image_files:
         image.mark_used()
@@ -402,7 +465,7 @@ async def remove_image(event: MessageEvent, params: str, matcher: Matcher):
             continue
 
         gallery = image.gallery
-        image.drop()
+        await run_db(image.drop)
         message_builder.text(f"已从画廊 {gallery.name} 中删除图片 {image_id}。")
     return await message_builder.send(matcher)
 
@@ -419,7 +482,7 @@ async def move_image(event: MessageEvent, params: str, matcher: Matcher):
         return await message_builder.text(f"没有找到图片").send(matcher)
     for image_id, image in images:
         if image:
-            image.move_to(gallery)
+            await run_db(image.move_to, gallery)
             message_builder.text(f"已将图片 {image.id} 移动到画廊 {target_gallery_name}。")
         else:
             message_builder.text(f"没有找到图片 {image_id}。")
@@ -444,7 +507,7 @@ async def random_image(event: MessageEvent, params: str, matcher: Matcher):
         return await show_image(event, params, matcher)
     unknown_args = []
 
-    filters = gallery_manager.get_filters(gallery_name)
+    filters = await run_db(gallery_manager.get_filters, gallery_name)
 
     count = 1
     count_str = ""
@@ -520,10 +583,10 @@ async def random_image(event: MessageEvent, params: str, matcher: Matcher):
             event).send(matcher)
 
     if need_all:
-        images = get_all_image(gallery, tags=filters.tags, comment=filters.comment)
+        images = await run_db(get_all_image, gallery, tags=filters.tags, comment=filters.comment)
         return await show_all(event, images, matcher)
 
-    images = get_random_image(gallery, tags=filters.tags, comment=filters.comment, count=count)
+    images = await run_db(get_random_image, gallery, tags=filters.tags, comment=filters.comment, count=count)
     if len(images) == 0:
         return await MessageBuilder().text(f"画廊 {filters.gallery} 中没有图片").reply_to(event).send(matcher)
 
@@ -559,7 +622,7 @@ async def show_image(event: MessageEvent, params: str, matcher: Matcher):
     for id_str in ids:
         if id_str.strip().isdigit():
             image_id = int(id_str)
-            image = gallery_manager.get_image_by_id(image_id)
+            image = await run_db(gallery_manager.get_image_by_id, image_id)
             if image:
                 images.append(image)
             else:
@@ -578,7 +641,7 @@ async def show_image(event: MessageEvent, params: str, matcher: Matcher):
 
 
 async def show_all(event: MessageEvent, images: list[ImageMeta], matcher: Matcher):
-    images = [(i, i.get_thumb_image()) for i in images]
+    images = list(zip(images, await load_thumbnails_of(images)))
 
     message_builder = MessageBuilder().reply_to(event)
     with Canvas(bg=FillBg((230, 240, 255, 255))).set_padding(8) as canvas:
@@ -613,7 +676,7 @@ async def modify_image(event: MessageEvent, params: str, matcher: Matcher):
             args.pop()
         for image_id_s in image_ids:
             image_id = int(image_id_s)
-            image = gallery_manager.get_image_by_id(image_id)
+            image = await run_db(gallery_manager.get_image_by_id, image_id)
             images.append(image)
     else:
         image_id_str = None
@@ -711,14 +774,14 @@ async def modify_image(event: MessageEvent, params: str, matcher: Matcher):
         if set(image.tags) != set(tags):
             message_builder.text(f"已修改图片ID {image.id}：")
             modified = True
-            image.update_tags(list(set(tags)))
+            await run_db(image.update_tags, list(set(tags)))
             message_builder.text(f"tag 为 {', '.join(image.tags)}")
         if comment is not None and image.comment != comment:
             if not modified:
                 message_builder.text(f"已修改图片ID {image.id}：")
                 modified = True
             message_builder.text(f"comment 由 \"{image.comment}\" 修改为 \"{comment}\"")
-            image.update_comment(comment)
+            await run_db(image.update_comment, comment)
         if not modified:
             message_builder.text(f"图片ID {image.id} 未做任何修改。")
     if len(message_builder.message) > 10:
@@ -805,7 +868,7 @@ async def set_alias(event: MessageEvent, params: str, matcher: Matcher):
             message_builder.text(f"警告：{warning}。")
 
     filters = GalleryFilter(gallery=gallery_name, tags=tags, comment=comment)
-    gallery_manager.set_filters(alias, filters)
+    await run_db(gallery_manager.set_filters, alias, filters)
 
     message_builder.text(f"已设置别名 {alias} 对应")
     if gallery_name != "*":
@@ -818,7 +881,7 @@ async def set_alias(event: MessageEvent, params: str, matcher: Matcher):
 
 
 async def list_aliases(event: MessageEvent, _params: str, matcher: Matcher):
-    aliases = gallery_manager.list_filters()
+    aliases = await run_db(gallery_manager.list_filters)
     if len(aliases) == 0:
         return await MessageBuilder().text("当前没有任何别名").reply_to(event).send(matcher)
     message_builder = MessageBuilder().reply_to(event)
@@ -839,9 +902,9 @@ async def remove_alias(event: MessageEvent, params: str, matcher: Matcher):
     alias = params.strip()
     if alias == "":
         return await reply_help(event, matcher)
-    if not gallery_manager.check_filter_exists(alias):
+    if not await run_db(gallery_manager.check_filter_exists, alias):
         return await MessageBuilder().text(f"没有找到别名 {alias}").reply_to(event).send(matcher)
-    gallery_manager.remove_filters(alias)
+    await run_db(gallery_manager.remove_filters, alias)
     return await MessageBuilder().text(f"已删除别名 {alias}").reply_to(event).send(matcher)
 
 
@@ -922,7 +985,7 @@ if gallery_config.enable_whateat:
         gallery = gallery_manager.find_gallery(gallery_name)
         if not gallery:
             return await MessageBuilder().text(f"没有找到画廊 {gallery_name}").reply_to(event).send(matcher)
-        images = get_random_image(gallery, count=1)
+        images = await run_db(get_random_image, gallery, count=1)
         if not images:
             return await MessageBuilder().text(f"画廊 {gallery_name} 中没有图片").reply_to(event).send(matcher)
         image = images[0]
@@ -958,7 +1021,7 @@ async def find_gallery_image_by_arg_or_event(arg_parser: ArgParser, event: Messa
     else:
         arg_parser.pop()
         image_id = int(image_id_str)
-        image = gallery_manager.get_image_by_id(image_id)
+        image = await run_db(gallery_manager.get_image_by_id, image_id)
     return image
 
 
@@ -989,38 +1052,40 @@ async def find_gallery_images_by_arg_or_event(arg_parser: ArgParser, event: Mess
     for image_id_str in image_ids_copy:
         image_ids.extend(parse_single_image_str(image_id_str))
 
-    images = [(image_id, gallery_manager.get_image_by_id(image_id)) for image_id in image_ids]
+    images = [(image_id, await run_db(gallery_manager.get_image_by_id, image_id)) for image_id in image_ids]
     images.extend([("", image) for image in await find_gallery_images_by_event(event)])
     return images
 
 
-async def find_gallery_image(image: tuple[str, str | None]) -> ImageMeta | None:
+async def find_gallery_images(images: list[tuple[str, str | None]]) -> list[ImageMeta | None]:
+    """批量查找图片，结果与 images 一一对应"""
     # search by file_id
-    if image[1]:
-        found_images = gallery_manager.get_images_by_file_id(image[1])
-        if len(found_images) > 0:
-            return found_images[0]
+    by_file_id = await run_db(gallery_manager.get_images_by_file_ids, [file_id for _, file_id in images if file_id])
+    found: list[ImageMeta | None] = [by_file_id.get(file_id) if file_id else None for _, file_id in images]
 
     # search by image content
-    image_file = (await download_images([image]))[0]
-    for gallery in gallery_manager.galleries:
-        sames = gallery.find_same_image(image_file.local_path)
-        if sames and len(sames) > 0:
-            return sames[0]
-    return None
+    missing = [i for i, image in enumerate(found) if image is None]
+    if not missing:
+        return found
+    image_files = await download_images([images[i] for i in missing])
+    phashes = await asyncio.gather(*(image_file.ensure_fingerprint() for image_file in image_files))
+    hashed = [(i, phash) for i, phash in zip(missing, phashes) if phash is not None]
+    sames = await run_db(gallery_manager.find_similar_phashes, [PhashWrapper(phash) for _, phash in hashed], limit=1)
+    for (i, _), same in zip(hashed, sames):
+        found[i] = same[0] if same else None
+    return found
+
+
+async def find_gallery_image(image: tuple[str, str | None]) -> ImageMeta | None:
+    return (await find_gallery_images([image]))[0]
 
 
 async def find_gallery_image_by_event(event: MessageEvent) -> ImageMeta | None:
-    images = await get_images_from_context(event)
+    images, _ = await get_images_from_context(event)
 
     return await find_gallery_image(images[0]) if len(images) > 0 else None
 
 
 async def find_gallery_images_by_event(event: MessageEvent) -> list[ImageMeta]:
-    images = await get_images_from_context(event)
-    found_images = []
-    for image in images:
-        img = await find_gallery_image(image)
-        if img:
-            found_images.append(img)
-    return found_images
+    images, _ = await get_images_from_context(event)
+    return [image for image in await find_gallery_images(images) if image]
@@ -12,13 +12,30 @@ _bot_name: str = "小遥"
 
 class Config(BaseModel):
     size_limit_mb: int = 10
+    cache_size_limit_mb: int = 1024
+    download_concurrency: int = 8
+    download_per_host_limit: int = 4
+    download_retries: int = 2
+    download_timeout: int = 60
     thumbnail_size: tuple[int, int] = (64, 64)
+    thumbnail_pyramid: list[int] = [64, 128, 256]
+    thumbnail_cache_mb: int = 64
+    thumbnail_atlas: bool = True
     repeat_image_show_size: tuple[int, int] = (128, 128)
     canvas_limit_size: tuple[int, int] = (4096, 4096)
     random_image_limit: int = 10
     enable_whateat: bool = False
     bot_id: int | None = None
 
+    @property
+    def thumbnail_levels(self) -> list[int]:
+        """缩略图金字塔的各级尺寸，总是包含渲染时直接用到的尺寸"""
+        return sorted({*self.thumbnail_pyramid, max(self.thumbnail_size), max(self.repeat_image_show_size)})
+
+    def thumbnail_level_for(self, size: tuple[int, int]) -> int | None:
+        """能满足 size 的最小一级缩略图，比最大一级还大时返回 None"""
+        return next((level for level in self.thumbnail_levels if level >= max(size)), None)
+
     @property
     def cache_dir(self) -> Path:
         """插件缓存目录"""
@@ -1,12 +1,80 @@
+import asyncio
+import functools
 import sqlite3
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
+from typing import Callable, ParamSpec, TypeVar
 
 from .config import gallery_config
 
 if not gallery_config.data_dir.exists():
     gallery_config.data_dir.mkdir(parents=True, exist_ok=True)
-db = sqlite3.connect(gallery_config.data_dir / "images.db")
-DB_VERSION = 4
+# 连接只在启动时和专用数据库线程中使用，见 run_db
+db = sqlite3.connect(gallery_config.data_dir / "images.db", check_same_thread=False)
+db.execute("pragma journal_mode=wal")
+db.execute("pragma synchronous=normal")
+DB_VERSION = 9
+
+PHASH_MASK = (1 << 64) - 1
+
+
+def _hamming(a: int | None, b: int | None) -> int | None:
+    if a is None or b is None:
+        return None
+    return ((a ^ b) & PHASH_MASK).bit_count()
+
+
+def _phash_from_hex(value: bytes | str | None) -> int | None:
+    """把旧版本以十六进制字符串保存的 pHash 转成有符号 64 位整数，仅供迁移使用"""
+    if value is None:
+        return None
+    if isinstance(value, bytes):
+        value = value.decode('utf-8')
+    unsigned = int(value, 16)
+    return unsigned - (1 << 64) if unsigned >= (1 << 63) else unsigned
+
+
+db.create_function("hamming", 2, _hamming, deterministic=True)
+db.create_function("phash_from_hex", 1, _phash_from_hex, deterministic=True)
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_db_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="haruka-gallery-db")
+
+
+async def run_db(fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    """在专用数据库线程中执行 fn，数据库读写和提交不会阻塞事件循环"""
+    return await asyncio.get_running_loop().run_in_executor(_db_executor,
+                                                            functools.partial(_run_checked, fn, *args, **kwargs))
+
+
+def _run_checked(fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    check_external_changes()
+    return fn(*args, **kwargs)
+
+
+_external_change_listeners: list[Callable[[], None]] = []
+_data_version: int | None = None
+
+
+def on_external_change(listener: Callable[[], None]):
+    """注册回调：其他进程 (例如导入脚本) 提交了修改后调用，用于丢弃内存中的索引，下次使用时重新加载"""
+    _external_change_listeners.append(listener)
+
+
+def check_external_changes():
+    """
+    pragma data_version 只在其他连接提交修改后变化，本连接自己的提交不会触发
+    run_db 每次执行前都会检查，所以运行中导入的图片也能立即被查重和随机抽取到
+    """
+    global _data_version
+    version = db.execute("pragma data_version").fetchone()[0]
+    if _data_version is not None and version != _data_version:
+        for listener in _external_change_listeners:
+            listener()
+    _data_version = version
+
 
 try:
     cursor = db.execute("SELECT version FROM meta LIMIT 1")
@@ -27,6 +95,11 @@ migration_map = {
     1: "migrate_1_2.sql",
     2: "migrate_2_3.sql",
     3: "migrate_3_4.sql",
+    4: "migrate_4_5.sql",
+    5: "migrate_5_6.sql",
+    6: "migrate_6_7.sql",
+    7: "migrate_7_8.sql",
+    8: "migrate_8_9.sql",
 }
 
 while current_version < DB_VERSION:
@@ -40,3 +113,5 @@ while current_version < DB_VERSION:
             current_version = row[0]
             continue
     raise RuntimeError(f"Unrecognized database version: {current_version}")
+
+check_external_changes()
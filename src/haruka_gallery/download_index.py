@@ -0,0 +1,114 @@
+import asyncio
+import functools
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, Optional, NamedTuple, ParamSpec, TypeVar
+from urllib.parse import urlsplit, urlunsplit, parse_qsl, urlencode
+
+from .config import gallery_config
+from .data import PHASH_MASK
+
+# QQ 图片链接里会变化的参数，去掉后才能作为同一张图片的标识
+VOLATILE_QUERY_KEYS = {'rkey'}
+
+
+def normalize_download_key(url: str, file_id: Optional[str] = None) -> str:
+    """下载缓存的键：优先使用 OneBot 的 file 字段，没有时使用去掉 rkey 的链接"""
+    if file_id and file_id.strip():
+        return "file:" + file_id.strip()
+    parts = urlsplit(url)
+    query = urlencode([(k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                       if k.lower() not in VOLATILE_QUERY_KEYS])
+    return "url:" + urlunsplit((parts.scheme, parts.netloc.lower(), parts.path, query, ''))
+
+
+class DownloadEntry(NamedTuple):
+    filename: str
+    sha256: Optional[str]
+    phash: Optional[int]
+
+
+class DownloadIndex:
+    """
+    下载缓存的持久化清单，记录 键 -> 缓存文件名、大小、最后访问时间、SHA-256 和 pHash
+
+    重启后或链接中的 rkey 变化后再次引用同一张图片时，可以直接使用缓存文件，不必重新下载和计算 pHash。
+    清理时按最后访问时间淘汰，直到总大小回到预算以内。命中时不写库，访问时间由清理前的 touch 批量写回。
+    所有方法都是同步的，事件循环中请通过 run_index 在专用线程中调用。
+    """
+    SCHEMA_VERSION = 3
+
+    def __init__(self, path):
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute("pragma journal_mode=wal")
+        self._db.execute("pragma synchronous=normal")
+        # 清单只是缓存，表结构或 pHash 算法变化时直接重建，旧文件会被当作孤儿清理
+        if self._db.execute("pragma user_version").fetchone()[0] != self.SCHEMA_VERSION:
+            self._db.execute("drop table if exists downloads")
+        self._db.execute("""
+            create table if not exists downloads (
+                key text primary key,
+                filename text not null,
+                size integer not null,
+                sha256 text,
+                phash integer,
+                last_access real not null
+            )""")
+        self._db.execute("create index if not exists downloads_last_access on downloads (last_access)")
+        self._db.execute(f"pragma user_version = {self.SCHEMA_VERSION}")
+        self._db.commit()
+
+    def get(self, key: str) -> Optional[DownloadEntry]:
+        row = self._db.execute("select filename, sha256, phash from downloads where key = ?", (key,)).fetchone()
+        if row is None:
+            return None
+        filename, sha256, phash = row
+        return DownloadEntry(filename, sha256, None if phash is None else phash & PHASH_MASK)
+
+    def put(self, key: str, filename: str, size: int, sha256: Optional[str], phash: Optional[int]):
+        if phash is not None and phash >= (1 << 63):
+            phash -= 1 << 64
+        with self._db:
+            self._db.execute("insert or replace into downloads values (?, ?, ?, ?, ?, ?)",
+                             (key, filename, size, sha256, phash, time.time()))
+
+    def remove(self, key: str):
+        with self._db:
+            self._db.execute("delete from downloads where key = ?", (key,))
+
+    def touch(self, accesses: Iterable[tuple[str, float]]):
+        """批量写回内存中命中的访问时间 (key, timestamp)"""
+        with self._db:
+            self._db.executemany("update downloads set last_access = max(last_access, ?) where key = ?",
+                                 [(timestamp, key) for key, timestamp in accesses])
+
+    def evict(self, budget: int) -> list[tuple[str, str]]:
+        """按最后访问时间从旧到新删除记录，直到总大小不超过 budget 字节，返回被删除的 (key, filename)"""
+        total = self._db.execute("select coalesce(sum(size), 0) from downloads").fetchone()[0]
+        evicted = []
+        if total > budget:
+            for key, filename, size in self._db.execute("select key, filename, size from downloads order by last_access"):
+                evicted.append((key, filename))
+                total -= size
+                if total <= budget:
+                    break
+            with self._db:
+                self._db.executemany("delete from downloads where key = ?", [(key,) for key, _ in evicted])
+        return evicted
+
+    def filenames(self) -> set[str]:
+        return {filename for filename, in self._db.execute("select filename from downloads")}
+
+
+download_index = DownloadIndex(gallery_config.data_dir / "downloads.db")
+
+P = ParamSpec("P")
+R = TypeVar("R")
+
+_index_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="haruka-gallery-downloads")
+
+
+async def run_index(fn: Callable[P, R], *args: P.args, **kwargs: P.kwargs) -> R:
+    """在下载清单的专用线程中执行 fn，和 run_db 分开，下载不会排在图库的数据库任务后面"""
+    return await asyncio.get_running_loop().run_in_executor(_index_executor, functools.partial(fn, *args, **kwargs))
@@ -0,0 +1,61 @@
+import hashlib
+from collections import OrderedDict
+from os import PathLike
+from typing import Optional
+
+import imagehash
+from PIL import Image
+
+
+# 本模块只依赖 PIL 和 imagehash，可以直接在子进程中执行
+
+
+def compute_phash(image: Image.Image, hash_size: int = 8) -> int:
+    return int(str(imagehash.phash(image, hash_size=hash_size)), 16)
+
+
+def compute_phash_from_path(image_path: PathLike | str, hash_size: int = 8) -> int:
+    # 必须按原图分辨率解码：库中已有的 pHash 都是这样算的，低分辨率解码会让同一张图的哈希偏移几位，挤占查重阈值
+    with Image.open(image_path) as img:
+        return compute_phash(img, hash_size=hash_size)
+
+
+def try_compute_phash_from_path(image_path: PathLike | str, hash_size: int = 8) -> Optional[int]:
+    try:
+        return compute_phash_from_path(image_path, hash_size=hash_size)
+    except Exception:
+        return None
+
+
+def sha256_of_file(path: PathLike | str) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class FingerprintCache:
+    """以文件内容的 SHA-256 为键缓存 pHash，同一份图片无论从哪个链接下载都只解码一次"""
+
+    def __init__(self, max_entries: int = 4096):
+        self.max_entries = max_entries
+        self._phashes: OrderedDict[str, Optional[int]] = OrderedDict()
+
+    def get(self, sha256: str) -> Optional[int]:
+        value = self._phashes.get(sha256)
+        if sha256 in self._phashes:
+            self._phashes.move_to_end(sha256)
+        return value
+
+    def put(self, sha256: str, value: Optional[int]):
+        self._phashes[sha256] = value
+        self._phashes.move_to_end(sha256)
+        while len(self._phashes) > self.max_entries:
+            self._phashes.popitem(last=False)
+
+    def __contains__(self, sha256: str) -> bool:
+        return sha256 in self._phashes
+
+
+fingerprint_cache = FingerprintCache()
@@ -1,23 +1,40 @@
 import io
 import json
 import shutil
+import weakref
 from os import PathLike
 from pathlib import Path
 from typing import Optional, Tuple, Generator, Callable
 
-import imagehash
 from PIL import Image
 from nonebot import logger
 
 from .config import gallery_config
-from .data import db
+from .data import db, PHASH_MASK, on_external_change
+from .fingerprint import compute_phash, compute_phash_from_path
+from .img_utils import THUMBNAIL_VERSION
+from .phash_index import phash_index, fingerprint_matrix
+from .sampler import random_sampler
+from .thumbnail_atlas import thumbnail_atlas
+from .tag_index import tag_index
+from .thumbnail_cache import thumbnail_cache
+
+
+def _chunked(items: list, size: int = 500) -> Generator[list, None, None]:
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
 
 
 class GalleryManager:
     galleries: list['Gallery']
+    images: weakref.WeakValueDictionary[int, 'ImageMeta']
 
     def __init__(self):
         self.galleries = []
+        self._galleries_by_id: dict[int, Gallery] = {}
+        self._galleries_by_name: dict[str, Gallery] = {}
+        self._indexed_names: dict[int, list[str]] = {}
+        self.images = weakref.WeakValueDictionary()
         self.load_galleries()
 
     def add_gallery(self, name: list[str], require_comment: bool = False) -> Optional['Gallery']:
@@ -25,26 +42,44 @@ class GalleryManager:
             if self.check_exists(n):
                 return None
         gallery = Gallery.new_unchecked(name, require_comment=require_comment)
-        self.galleries.append(gallery)
+        self.register_gallery(gallery)
         return gallery
 
+    def register_gallery(self, gallery: 'Gallery'):
+        if gallery.id not in self._galleries_by_id:
+            self.galleries.append(gallery)
+            self._galleries_by_id[gallery.id] = gallery
+        self.reindex_gallery(gallery)
+
+    def reindex_gallery(self, gallery: 'Gallery'):
+        """画廊名称变化后调用，重建该画廊的名称索引"""
+        old_names = self._indexed_names.pop(gallery.id, [])
+        if gallery.id in self._galleries_by_id:
+            self._indexed_names[gallery.id] = list(gallery.name)
+        self._reindex_names([*old_names, *gallery.name])
+
+    def _reindex_names(self, names: list[str]):
+        # 多个画廊可以有相同的别名，和逐个遍历 galleries 一样取列表中第一个带有该名称的画廊
+        for name in set(names):
+            owner = next((g for g in self.galleries if name in self._indexed_names.get(g.id, ())), None)
+            if owner is None:
+                self._galleries_by_name.pop(name, None)
+            else:
+                self._galleries_by_name[name] = owner
+
+    def unregister_gallery(self, gallery: 'Gallery'):
+        if self._galleries_by_id.pop(gallery.id, None) is not None:
+            self.galleries.remove(gallery)
+        self._reindex_names(self._indexed_names.pop(gallery.id, []))
+
     def check_exists(self, name: str) -> bool:
-        for gallery in self.galleries:
-            if name in gallery.name:
-                return True
-        return False
+        return name in self._galleries_by_name
 
     def find_gallery(self, name: str) -> Optional['Gallery']:
-        for gallery in self.galleries:
-            if name in gallery.name:
-                return gallery
-        return None
+        return self._galleries_by_name.get(name)
 
     def get_gallery_by_id(self, gallery_id: int):
-        for gallery in self.galleries:
-            if gallery.id == gallery_id:
-                return gallery
-        return None
+        return self._galleries_by_id.get(gallery_id)
 
     def set_filters(self, name: str, filters: 'GalleryFilter'):
         if self.check_exists(name):
@@ -87,8 +122,9 @@ class GalleryManager:
         db.execute("delete from aliases where name=?", (name,))
         db.commit()
 
-    @staticmethod
-    def get_image_by_id(image_id: int) -> Optional['ImageMeta']:
+    def get_image_by_id(self, image_id: int) -> Optional['ImageMeta']:
+        if image := self.images.get(image_id):
+            return image
         cursor = db.execute(
             f"select {ImageMeta.row_contents()} from images where id=?",
             (image_id,))
@@ -97,28 +133,76 @@ class GalleryManager:
             return ImageMeta.from_row(row)
         return None
 
-    @staticmethod
-    def get_images_by_file_id(file_id: str) -> list['ImageMeta']:
+    def get_images_by_ids(self, image_ids: list[int]) -> list['ImageMeta']:
+        """按给定顺序批量获取图片，不存在的 id 会被忽略"""
+        images = {image_id: image for image_id in image_ids if (image := self.images.get(image_id))}
+        missing_ids = [image_id for image_id in image_ids if image_id not in images]
+        rows = []
+        for chunk in _chunked(missing_ids):
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor = db.execute(
+                f"select {ImageMeta.row_contents()} from images where id in ({placeholders})",
+                chunk)
+            rows.extend(cursor.fetchall())
+        images.update({image.id: image for image in ImageMeta.from_rows(rows)})
+        return [images[image_id] for image_id in image_ids if image_id in images]
+
+    def get_images_by_file_id(self, file_id: str) -> list['ImageMeta']:
         cursor = db.execute(
             f"select {ImageMeta.row_contents()} from images where file_id=?",
             (file_id,))
-        rows = cursor.fetchall()
-        images = []
-        for row in rows:
-            image_meta = ImageMeta.from_row(row)
-            images.append(image_meta)
+        return ImageMeta.from_rows(cursor.fetchall())
+
+    def get_images_by_file_ids(self, file_ids: list[str]) -> dict[str, 'ImageMeta']:
+        """批量按 file_id 查找图片，同一个 file_id 对应多张图片时取 id 最小的"""
+        rows = []
+        for chunk in _chunked(list(dict.fromkeys(file_ids))):
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor = db.execute(
+                f"select {ImageMeta.row_contents()} from images where file_id in ({placeholders}) order by id",
+                chunk)
+            rows.extend(cursor.fetchall())
+        images = {}
+        for image in ImageMeta.from_rows(rows):
+            images.setdefault(image.file_id, image)
         return images
 
+    def find_similar_phash(self, phash: 'PhashWrapper', threshold: int = 5) -> list['ImageMeta']:
+        matches = fingerprint_matrix.query(phash.to_int(), threshold)
+        return self.get_images_by_ids([image_id for image_id, _, _ in matches])
+
+    def find_similar_phashes(self, phashes: list['PhashWrapper'], threshold: int = 5,
+                             limit: Optional[int] = None) -> list[list['ImageMeta']]:
+        """find_similar_phash 的批量版本，所有哈希在一次矩阵运算中比较，结果与 phashes 一一对应"""
+        matches = fingerprint_matrix.query_many([phash.to_int() for phash in phashes], threshold, limit)
+        images = {image.id: image for image in
+                  self.get_images_by_ids(list({image_id for match in matches for image_id, _, _ in match}))}
+        return [[images[image_id] for image_id, _, _ in match if image_id in images] for match in matches]
+
     def load_galleries(self):
+        """按数据库同步画廊列表，已有的画廊对象原地更新"""
         cursor = db.execute("select id, name, require_comment from galleries")
         rows = cursor.fetchall()
         for row in rows:
+            if gallery := self._galleries_by_id.get(row[0]):
+                gallery.name = row[1].split(" ")
+                gallery.require_comment = bool(row[2])
+                self.reindex_gallery(gallery)
+                continue
             gallery = Gallery(
                 gallery_id=row[0],
                 name=row[1].split(" "),
                 require_comment=bool(row[2])
             )
-            self.galleries.append(gallery)
+            self.register_gallery(gallery)
+        gallery_ids = {row[0] for row in rows}
+        for gallery in [gallery for gallery in self.galleries if gallery.id not in gallery_ids]:
+            self.unregister_gallery(gallery)
+
+    def reload(self):
+        """其他进程修改数据库后调用，重新同步画廊并丢弃缓存的图片对象"""
+        self.images = weakref.WeakValueDictionary()
+        self.load_galleries()
 
 
 class Gallery:
@@ -142,10 +226,13 @@ class Gallery:
         )
 
     def add_image_unchecked(self, image_path: PathLike | str, comment, tags: list[str], uploader: str,
-                            file_id: Optional[str] = None) -> 'ImageMeta':
+                            file_id: Optional[str] = None, phash: Optional['PhashWrapper'] = None,
+                            commit: bool = True) -> 'ImageMeta':
+        """phash 已经算好时可以直接传入；commit 为 False 时由调用方负责提交事务"""
         suffix = Path(image_path).suffix
-        phash = PhashWrapper.from_image_path(image_path)
-        meta = ImageMeta.new_unchecked(self, comment, tags, suffix, uploader, phash, file_id=file_id)
+        if phash is None:
+            phash = PhashWrapper.from_image_path(image_path)
+        meta = ImageMeta.new_unchecked(self, comment, tags, suffix, uploader, phash, file_id=file_id, commit=commit)
         image_id = meta.id
         ext = Path(image_path).suffix
         dest_dir = gallery_config.data_dir / str(self.id) / (str(image_id) + ext)
@@ -158,12 +245,7 @@ class Gallery:
         cursor = db.execute(
             f"select {ImageMeta.row_contents()} from images where gallery_id=?",
             (self.id,))
-        rows = cursor.fetchall()
-        images = []
-        for row in rows:
-            image_meta = ImageMeta.from_row(row)
-            images.append(image_meta)
-        return images
+        return ImageMeta.from_rows(cursor.fetchall())
 
     def count_images(self) -> int:
         cursor = db.execute(
@@ -178,78 +260,45 @@ class Gallery:
             image.drop()
         db.execute("delete from galleries where id=?", (self.id,))
         db.commit()
+        gallery_manager.unregister_gallery(self)
         gallery_path = gallery_config.data_dir / str(self.id)
         if gallery_path.exists():
             shutil.rmtree(gallery_path)
 
-    def find_same_image(self, image: PathLike | str) -> list['ImageMeta']:
-        phash = PhashWrapper.from_image_path(image)
-        images = self.list_images()
-        same_images = []
-        for img in images:
-            same, distance = img.check_similarity(phash)
-            if same:
-                same_images.append((img, distance))
-        same_images.sort(key=lambda x: x[1])
-        return [img[0] for img in same_images]
+    def find_same_image(self, image: PathLike | str, threshold: int = 5) -> list['ImageMeta']:
+        return self.find_same_phash(PhashWrapper.from_image_path(image), threshold)
+
+    def find_same_phash(self, phash: 'PhashWrapper', threshold: int = 5) -> list['ImageMeta']:
+        matches = phash_index.query(phash.to_int(), threshold, gallery_id=self.id)
+        return gallery_manager.get_images_by_ids([image_id for image_id, _ in matches])
 
     def update_name(self):
         db.execute("update galleries set name=? where id=?", (" ".join(self.name), self.id))
         db.commit()
+        gallery_manager.reindex_gallery(self)
 
     def update_require_comment(self, require: bool):
         db.execute("update galleries set require_comment=? where id=?", (1 if require else 0, self.id))
         db.commit()
         self.require_comment = require
 
-    def iter_images_with_thumbs(self) -> Generator[Tuple['ImageMeta', Image.Image], None, None]:
-        sql = f"""
-              select {ImageMeta.row_contents(lambda x: 'i.' + x)}, t.data 
-              from images i
-                    left join thumbnails t on i.id = t.image_id
-              where i.gallery_id = ? 
-              """
-
-        cursor = db.execute(sql, (self.id,))
-
-        for row in cursor:
-            meta_row = row[:9]
-            thumb_blob = row[9]
-
-            image_meta = ImageMeta.from_row(meta_row)
-
-            img_obj = None
-
-            if thumb_blob:
-                try:
-                    img_obj = Image.open(io.BytesIO(thumb_blob))
-                    img_obj.load()
-                except Exception as e:
-                    logger.error(f"缩略图数据损坏 {image_meta.id}: {e}")
-                    img_obj = None
-
-            if img_obj is None:
-                img_obj = image_meta.get_thumb_image()
-
-            yield image_meta, img_obj
-
 
 class PhashWrapper:
-    def __init__(self, hash_obj: imagehash.ImageHash):
-        if not isinstance(hash_obj, imagehash.ImageHash):
-            raise ValueError("必须使用一个 imagehash.ImageHash 对象进行初始化。")
-        self.phash = hash_obj
+    value: int
+
+    def __init__(self, value: int):
+        if not isinstance(value, int):
+            raise ValueError("必须使用一个无符号 64 位整数进行初始化。")
+        self.value = value & PHASH_MASK
 
     @classmethod
     def from_image(cls, pil_image: Image.Image, hash_size: int = 8) -> 'PhashWrapper':
-        hash_obj = imagehash.phash(pil_image, hash_size=hash_size)
-        return cls(hash_obj=hash_obj)
+        return cls(compute_phash(pil_image, hash_size=hash_size))
 
     @classmethod
     def from_image_path(cls, image_path: str, hash_size: int = 8) -> 'PhashWrapper':
         try:
-            img = Image.open(image_path)
-            return cls.from_image(img, hash_size=hash_size)
+            return cls(compute_phash_from_path(image_path, hash_size=hash_size))
         except FileNotFoundError:
             print(f"错误: 文件未找到 {image_path}")
             raise
@@ -257,44 +306,31 @@ class PhashWrapper:
             print(f"加载图片时出错: {e}")
             raise
 
-    def export_to_buffer(self) -> bytes:
-        # 1. 将 pHash 对象转换为其标准的十六进制字符串表示
-        hex_string = str(self.phash)
-
-        # 2. 将该字符串编码为 bytes (即 "Buffer")
-        return hex_string.encode('utf-8')
+    def to_sql(self) -> int:
+        # SQLite 的 integer 是有符号 64 位，最高位为 1 的哈希按补码存储
+        return self.value - (1 << 64) if self.value >= (1 << 63) else self.value
 
     @classmethod
-    def from_buffer(cls, buffer: bytes) -> 'PhashWrapper':
-        try:
-            # 1. 将 bytes (Buffer) 解码回十六进制字符串
-            restored_hex_string = buffer.decode('utf-8')
-
-            # 2. 使用 imagehash 库的标准函数从十六进制重建 ImageHash 对象
-            hash_obj = imagehash.hex_to_hash(restored_hex_string)
-
-            return cls(hash_obj=hash_obj)
-        except UnicodeDecodeError:
-            print("错误: Buffer 不是有效的 UTF-8 编码。")
-            raise
-        except Exception as e:
-            print(f"错误: 无法从十六进制字符串 '{restored_hex_string}' 创建哈希: {e}")
-            raise
+    def from_sql(cls, value: int) -> 'PhashWrapper':
+        return cls(value)
 
     def get_hex_string(self) -> str:
-        return str(self.phash)
+        return f"{self.value:016x}"
+
+    def to_int(self) -> int:
+        return self.value
 
     def compare_distance(self, other: 'PhashWrapper') -> int:
         if not isinstance(other, PhashWrapper):
             raise TypeError("只能与另一个 PhashWrapper 实例进行比较。")
-        return self.phash - other.phash
+        return (self.value ^ other.value).bit_count()
 
     def __str__(self) -> str:
         return self.get_hex_string()
 
     def __eq__(self, other) -> bool:
         if isinstance(other, PhashWrapper):
-            return self.phash == other.phash
+            return self.value == other.value
         return False
 
     def __sub__(self, other):
@@ -303,7 +339,7 @@ class PhashWrapper:
         raise TypeError("只能与另一个 PhashWrapper 实例进行减法操作。")
 
     def __repr__(self) -> str:
-        return f"<PhashWrapper hash='{self.phash}'>"
+        return f"<PhashWrapper hash='{self.get_hex_string()}'>"
 
 
 class ImageMeta:
@@ -336,20 +372,23 @@ class ImageMeta:
 
     @classmethod
     def new_unchecked(cls, gallery: Gallery, comment: str, tags: list[str], suffix: str, uploader: str,
-                      phash: PhashWrapper, file_id: Optional[str] = None) -> 'ImageMeta':
-        binary_phash = phash.export_to_buffer()
-        tag_ids = ImageMeta.get_or_create_tags(tags)
+                      phash: PhashWrapper, file_id: Optional[str] = None, commit: bool = True) -> 'ImageMeta':
+        tag_ids = ImageMeta.get_or_create_tags(tags, commit=commit)
         cursor = db.execute(
             "insert into images (gallery_id, comment, suffix, uploader, file_id, phash) VALUES (?,?,?,?,?,?)",
-            (gallery.id, comment, suffix, uploader, file_id, binary_phash))
-        db.commit()
+            (gallery.id, comment, suffix, uploader, file_id, phash.to_sql()))
         cursor = db.execute("select id, datetime(created_at, 'localtime') from images where id=?", (cursor.lastrowid,))
         row = cursor.fetchone()
         image_id = row[0]
         for tag_id in tag_ids:
             db.execute("insert into image_tags (image_id, tag_id) VALUES (?,?)", (image_id, tag_id))
-        db.commit()
-        return ImageMeta(
+        if commit:
+            db.commit()
+        tag_index.set_image_tags(image_id, tag_ids)
+        phash_index.add(image_id, gallery.id, phash.to_int())
+        fingerprint_matrix.add(image_id, gallery.id, phash.to_int())
+        random_sampler.invalidate()
+        image = ImageMeta(
             image_id=image_id,
             gallery=gallery,
             comment=comment,
@@ -360,6 +399,8 @@ class ImageMeta:
             phash=phash,
             create_time=row[1]
         )
+        gallery_manager.images[image_id] = image
+        return image
 
     @staticmethod
     def row_contents(f: Optional[Callable[[str], str]] = None) -> str:
@@ -377,57 +418,70 @@ class ImageMeta:
 
     @classmethod
     def from_row(cls, row) -> 'ImageMeta':
-        gallery = GalleryManager().get_gallery_by_id(row[1])
-        image_id = row[0]
-        cursor = db.execute("select tag_id from image_tags where image_id=?", (image_id,))
-        tag_rows = cursor.fetchall()
-        tag_ids = [tag_row[0] for tag_row in tag_rows]
-        tags = []
-        for tag_id in tag_ids:
-            cursor = db.execute("select name from tags where id=?", (tag_id,))
-            tag_row = cursor.fetchone()
-            if tag_row:
-                tags.append(tag_row[0])
-        phash = PhashWrapper.from_buffer(row[5])
-        return cls(
-            image_id=image_id,
-            gallery=gallery,
-            comment=row[2],
-            tags=tags,
-            suffix=row[3],
-            uploader=row[4],
-            phash=phash,
-            file_id=row[6],
-            create_time=row[7]
-        )
+        return cls.from_rows([row])[0]
+
+    @classmethod
+    def from_rows(cls, rows: list) -> list['ImageMeta']:
+        """批量构造，标签用一次联表查询取回，画廊从 gallery_manager 中取，已存活的对象直接复用"""
+        live = gallery_manager.images
+        hits = {row[0]: image for row in rows if (image := live.get(row[0]))}
+        tags_map: dict[int, list[str]] = {}
+        for chunk in _chunked([row[0] for row in rows if row[0] not in hits]):
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor = db.execute(f"""
+                select it.image_id, t.name
+                from image_tags it
+                    join tags t on t.id = it.tag_id
+                where it.image_id in ({placeholders})
+                order by it.image_id, it.tag_id
+                """, chunk)
+            for image_id, tag_name in cursor:
+                tags_map.setdefault(image_id, []).append(tag_name)
+        images = []
+        for row in rows:
+            image_id = row[0]
+            if image := hits.get(image_id):
+                images.append(image)
+                continue
+            image = cls(
+                image_id=image_id,
+                gallery=gallery_manager.get_gallery_by_id(row[1]),
+                comment=row[2],
+                tags=tags_map.get(image_id, []),
+                suffix=row[3],
+                uploader=row[4],
+                phash=PhashWrapper.from_sql(row[5]),
+                file_id=row[6],
+                create_time=row[7]
+            )
+            live[image_id] = image
+            images.append(image)
+        return images
 
     @staticmethod
     def get_tags(tags: list[str]) -> Tuple[list[int], list[str]]:
         tag_ids = []
         undefined_tags = []
         for tag in tags:
-            cursor = db.execute("select id from tags where name=?", (tag,))
-            result = cursor.fetchone()
-            if result is None:
+            tag_id = tag_index.get_tag_id(tag)
+            if tag_id is None:
                 undefined_tags.append(tag)
             else:
-                tag_id = result[0]
                 tag_ids.append(tag_id)
 
         return tag_ids, undefined_tags
 
     @staticmethod
-    def get_or_create_tags(tags: list[str]) -> list[int]:
+    def get_or_create_tags(tags: list[str], commit: bool = True) -> list[int]:
         tag_ids = []
         for tag in tags:
-            result = None
-            while result is None:
-                cursor = db.execute("select id from tags where name=?", (tag,))
-                result = cursor.fetchone()
-                if result is None:
-                    db.execute("insert into tags (name) VALUES (?)", (tag,))
+            tag_id = tag_index.get_tag_id(tag)
+            if tag_id is None:
+                cursor = db.execute("insert into tags (name) VALUES (?)", (tag,))
+                if commit:
                     db.commit()
-            tag_id = result[0]
+                tag_id = cursor.lastrowid
+                tag_index.add_tag(tag, tag_id)
             tag_ids.append(tag_id)
         return tag_ids
 
@@ -449,12 +503,15 @@ class ImageMeta:
             if tag_id not in current_tag_ids:
                 db.execute("insert into image_tags (image_id, tag_id) VALUES (?,?)", (self.id, tag_id))
         db.commit()
+        tag_index.set_image_tags(self.id, tag_ids)
         self.tags = new_tags
+        random_sampler.invalidate()
 
     def update_comment(self, new_comment: str):
         db.execute("update images set comment=? where id=?", (new_comment, self.id))
         db.commit()
         self.comment = new_comment
+        random_sampler.invalidate()
 
     def update_file_id(self, new_file_id: Optional[str]):
         db.execute("update images set file_id=? where id=?", (new_file_id, self.id))
@@ -471,10 +528,21 @@ class ImageMeta:
         new_path = new_dir / self.get_file_name()
         shutil.move(old_path, new_path)
         self.gallery = new_gallery
+        phash_index.move(self.id, new_gallery.id)
+        fingerprint_matrix.move(self.id, new_gallery.id)
+        random_sampler.invalidate()
 
     def drop(self):
         db.execute("delete from images where id=?", (self.id,))
+        db.execute("delete from image_tags where image_id=?", (self.id,))
         db.commit()
+        tag_index.remove_image(self.id)
+        phash_index.remove(self.id)
+        fingerprint_matrix.remove(self.id)
+        random_sampler.invalidate()
+        thumbnail_cache.invalidate(self.id)
+        thumbnail_atlas.remove(self.id)
+        gallery_manager.images.pop(self.id, None)
         image_path = self.get_image_path()
         if image_path.exists():
             image_path.unlink()
@@ -491,38 +559,7 @@ class ImageMeta:
         distance = self.phash - other
         return distance <= threshold, distance
 
-    def get_thumb_image(self) -> Optional[Image.Image]:
-        image_id = self.id
-
-        cursor = db.execute("SELECT data FROM thumbnails WHERE image_id = ?", (image_id,))
-        row = cursor.fetchone()
-
-        thumb_data = None
-
-        if row:
-            thumb_data = row[0]
-        else:
-            try:
-                original_path = self.get_image_path()
-
-                with Image.open(original_path) as img:
-                    img = img.convert('RGBA')
-                    img.thumbnail(gallery_config.thumbnail_size)
-
-                    output_buffer = io.BytesIO()
-                    img.save(output_buffer, format='WebP', optimize=True, quality=85)
-                    thumb_data = output_buffer.getvalue()
-
-                db.execute(
-                    "insert into thumbnails (image_id, data) values (?, ?)",
-                    (image_id, thumb_data)
-                )
-                db.commit()
-
-            except Exception as e:
-                logger.warning(f'生成缩略图失败 {self.id}: {e}')
-                return None
-
+    def decode_thumb_data(self, thumb_data: Optional[bytes]) -> Optional[Image.Image]:
         if thumb_data:
             try:
                 bio = io.BytesIO(thumb_data)
@@ -537,6 +574,14 @@ class ImageMeta:
 
         return None
 
+    def decode_thumb_level(self, level: int, thumb_data: Optional[bytes]) -> Optional[Image.Image]:
+        """解码一级缩略图并放入 thumbnail_cache，返回可以修改的副本"""
+        img = self.decode_thumb_data(thumb_data)
+        if img is None:
+            return None
+        thumbnail_cache.put(self.id, level, img)
+        return img.copy()
+
 
 class GalleryFilter:
     gallery: str
@@ -550,95 +595,142 @@ class GalleryFilter:
 
 
 gallery_manager = GalleryManager()
+on_external_change(gallery_manager.reload)
+
+
+def filter_image_ids(gallery: Optional[Gallery], tags: Optional[list[str]] = None,
+                     comment: Optional[str] = None) -> list[int]:
+    """符合筛选条件的图片 id，升序；标签先在 tag_index 中求交集，再用 SQL 筛选画廊和备注"""
+    tag_ids, undefined_tags = ImageMeta.get_tags(tags or [])
+    if len(undefined_tags) > 0:
+        return []
+    conditions = []
+    params = []
+    if gallery is not None:
+        conditions.append("gallery_id = ?")
+        params.append(gallery.id)
+    if comment is not None:
+        if len(comment) >= 3:
+            # trigram 分词至少需要 3 个字符，短于 3 个字符时索引帮不上忙，只能扫表
+            conditions.append("id in (select rowid from images_fts where images_fts match ?)")
+            params.append('"' + comment.replace('"', '""') + '"')
+        else:
+            conditions.append("comment like ?")
+            params.append(f"%{comment}%")
+    if len(tag_ids) > 0:
+        candidates = tag_index.image_ids(tag_ids)
+        if len(conditions) == 0:
+            return candidates
+        image_ids = []
+        for chunk in _chunked(candidates):
+            placeholders = ', '.join(['?'] * len(chunk))
+            cursor = db.execute(f"""
+                select id from images
+                where id in ({placeholders}) and {' and '.join(conditions)}
+                order by id
+                """, chunk + params)
+            image_ids.extend(row[0] for row in cursor)
+        return image_ids
+    where = f"where {' and '.join(conditions)}" if len(conditions) > 0 else ""
+    cursor = db.execute(f"select id from images {where} order by id", params)
+    return [row[0] for row in cursor]
 
 
 def get_all_image(gallery: Optional[Gallery], tags: Optional[list[str]] = None, comment: Optional[str] = None) -> list[
     ImageMeta]:
-    if tags is None:
-        tags = []
-    tag_ids_res = ImageMeta.get_tags(tags)
-    if len(tag_ids_res[1]) > 0:
-        return []
-    tag_ids = tag_ids_res[0]
-    placeholders = ', '.join(['?'] * len(tag_ids))
-    search_tags = f"""
-        and i.id in (
-            select it.image_id
-            from image_tags it
-            where
-                it.tag_id in ({placeholders})
-            group by
-                it.image_id
-            having 
-                count(distinct it.tag_id) = ?
-        )
-        """ if len(tag_ids) > 0 else ""
-    tags_param = (tag_ids + [len(tag_ids)]) if len(tag_ids) > 0 else []
-    search_comment = " and i.comment like ? " if comment is not None else ""
-    comment_param = [f"%{comment}%"] if comment is not None else []
-    search_gallery = "and i.gallery_id = ?" if gallery is not None else ""
-    gallery_param = [gallery.id] if gallery is not None else []
-    cursor = db.execute(f"""
-        select {ImageMeta.row_contents(lambda x: 'i.' + x)}
-        from images i
-        where
-            1 = 1 
-            {search_gallery}
-            {search_comment}
-            {search_tags}
-        order by id;
-        """, gallery_param + comment_param + tags_param)
-    rows = cursor.fetchall()
-    images = []
-    for row in rows:
-        image_meta = ImageMeta.from_row(row)
-        images.append(image_meta)
-    return images
+    return gallery_manager.get_images_by_ids(filter_image_ids(gallery, tags, comment))
 
 
 def get_random_image(gallery: Optional[Gallery], tags: Optional[list[str]] = None, comment: Optional[str] = None,
                      count: int = 1) -> list[ImageMeta]:
-    if tags is None:
-        tags = []
-    tag_ids_res = ImageMeta.get_tags(tags)
-    if len(tag_ids_res[1]) > 0:
+    tag_ids, undefined_tags = ImageMeta.get_tags(tags or [])
+    if len(undefined_tags) > 0:
         return []
-    tag_ids = tag_ids_res[0]
-    placeholders = ', '.join(['?'] * len(tag_ids))
-    search_tags = f"""
-        and i.id in (
-            select it.image_id
-            from image_tags it
-            where
-                it.tag_id in ({placeholders})
-            group by
-                it.image_id
-            having 
-                count(distinct it.tag_id) = ?
-        )
-        """ if len(tag_ids) > 0 else ""
-    tags_param = (tag_ids + [len(tag_ids)]) if len(tag_ids) > 0 else []
-    search_comment = " and i.comment like ? " if comment is not None else ""
-    comment_param = [f"%{comment}%"] if comment is not None else []
-    search_gallery = "and i.gallery_id = ?" if gallery is not None else ""
-    gallery_param = [gallery.id] if gallery is not None else []
+    key = (gallery.id if gallery is not None else None, tuple(sorted(set(tag_ids))), comment)
+    image_ids = random_sampler.sample(key, lambda: filter_image_ids(gallery, tags, comment), count)
+    return gallery_manager.get_images_by_ids(image_ids)
+
+
+def get_images_without_thumbnails(after_id: int = 0, limit: int = 64) -> list[ImageMeta]:
+    """按 id 升序返回 id 大于 after_id 且缺少当前版本某一级缩略图的图片"""
+    levels = gallery_config.thumbnail_levels
     cursor = db.execute(f"""
         select {ImageMeta.row_contents(lambda x: 'i.' + x)}
         from images i
-        where
-            1 = 1 
-            {search_gallery}
-            {search_comment}
-            {search_tags}
-        order by random()
-        limit ?;
-        """, gallery_param + comment_param + tags_param + [count])
-    rows = cursor.fetchall()
-    images = []
-    for row in rows:
-        image_meta = ImageMeta.from_row(row)
-        images.append(image_meta)
-    return images
+        where i.id > ?
+          and (select count(*) from thumbnails t
+               where t.image_id = i.id and t.version = ? and t.size in ({', '.join(['?'] * len(levels))})) < ?
+        order by i.id
+        limit ?
+        """, (after_id, THUMBNAIL_VERSION, *levels, len(levels), limit))
+    return ImageMeta.from_rows(cursor.fetchall())
+
+
+def get_thumb_data_many(image_ids: list[int], level: int) -> dict[int, bytes]:
+    """一次查询取出一批图片当前版本的某一级缩略图数据，没有的不在返回结果中"""
+    result = {}
+    for chunk in _chunked(image_ids):
+        cursor = db.execute(f"""
+            select t.image_id, t.data
+            from images i
+                     join thumbnails t on i.id = t.image_id and t.size = ? and t.version = ?
+            where i.id in ({', '.join(['?'] * len(chunk))})
+            """, (level, THUMBNAIL_VERSION, *chunk))
+        result.update(cursor.fetchall())
+    return result
+
+
+def save_thumbnails(items: list[Tuple[int, int, bytes]]):
+    """在一个事务中批量写入当前版本的 (image_id, 尺寸, 缩略图数据)，图片已被删除的跳过"""
+    with db:
+        db.executemany(f"""
+            insert or replace into thumbnails (image_id, size, version, data)
+            select ?1, ?2, {THUMBNAIL_VERSION}, ?3 where exists (select 1 from images where id = ?1)
+            """, items)
+    for image_id in {image_id for image_id, _, _ in items}:
+        thumbnail_cache.invalidate(image_id)
+    _put_atlas_tiles([(image_id, data) for image_id, size, data in items if size == thumbnail_atlas.tile])
+
+
+def _put_atlas_tiles(items: list[Tuple[int, bytes]]) -> int:
+    """解码 (image_id, 缩略图数据) 并写入图集，返回写入的数量"""
+    if not thumbnail_atlas.enabled:
+        return 0
+    tiles = []
+    for image_id, data in items:
+        try:
+            with Image.open(io.BytesIO(data)) as img:
+                img.load()
+                tiles.append((image_id, img.convert('RGBA')))
+        except Exception as e:
+            logger.error(f"缩略图数据损坏 {image_id}: {e}")
+    thumbnail_atlas.put_many(tiles)
+    return len(tiles)
+
+
+def fill_thumbnail_atlas(limit: int = 256) -> int:
+    """把已有但还不在图集中的缩略图写入图集，返回写入的数量，损坏的缩略图会被跳过，用于升级后或重建图集后在后台补齐"""
+    if not thumbnail_atlas.enabled:
+        return 0
+    rows = db.execute("""
+        select t.image_id, t.data from thumbnails t
+        where t.size = ? and t.version = ?
+          and not exists (select 1 from thumbnail_atlas a where a.image_id = t.image_id)
+        limit ?
+        """, (thumbnail_atlas.tile, THUMBNAIL_VERSION, limit)).fetchall()
+    return _put_atlas_tiles(rows)
+
+
+def delete_stale_thumbnails() -> int:
+    """删除旧版本、不再使用的尺寸以及图片已被删除的缩略图"""
+    levels = gallery_config.thumbnail_levels
+    with db:
+        cursor = db.execute(f"""
+            delete from thumbnails
+            where version != ? or size not in ({', '.join(['?'] * len(levels))})
+               or not exists (select 1 from images where id = thumbnails.image_id)
+            """, (THUMBNAIL_VERSION, *levels))
+    return cursor.rowcount
 
 
 if gallery_config.enable_whateat:
@@ -0,0 +1,147 @@
+import asyncio
+from os import PathLike
+from typing import Optional
+
+from PIL import Image
+from nonebot import logger
+
+from .config import gallery_config
+from .data import run_db
+from .fingerprint import try_compute_phash_from_path
+from .gallery import ImageMeta, get_images_without_thumbnails, save_thumbnails, delete_stale_thumbnails, \
+    fill_thumbnail_atlas, get_thumb_data_many
+from .img_utils import make_thumbnails, make_thumbnail_pyramids_data, probe_image_extension
+from .process_pool import ProcessPool
+from .thumbnail_atlas import thumbnail_atlas
+from .thumbnail_cache import thumbnail_cache
+
+IMAGE_PROCESS_NUM = 2
+# 预生成缩略图时每批从数据库取出的图片数、每个子进程任务处理的图片数
+THUMBNAIL_BATCH_SIZE = 64
+THUMBNAIL_TASK_SIZE = 8
+
+# 解码图片、计算 pHash、生成缩略图都是 CPU 密集的操作，放到子进程中执行，避免阻塞事件循环
+_image_pool: ProcessPool = ProcessPool(IMAGE_PROCESS_NUM, name='image')
+
+
+async def compute_phash(image_path: PathLike | str) -> Optional[int]:
+    """无法解码时返回 None"""
+    return await _image_pool.submit(try_compute_phash_from_path, str(image_path))
+
+
+async def probe_extension(image_path: PathLike | str) -> Optional[str]:
+    return await _image_pool.submit(probe_image_extension, str(image_path))
+
+
+async def load_thumbnails(image_paths: list[PathLike | str], size: tuple[int, int]) -> list[Optional[Image.Image]]:
+    """读取并缩小一批图片，无法读取的对应 None"""
+    if not image_paths:
+        return []
+    return await _image_pool.submit(make_thumbnails, [str(p) for p in image_paths], size)
+
+
+async def load_thumbnails_of(images: list[ImageMeta], size: Optional[tuple[int, int]] = None) \
+        -> list[Optional[Image.Image]]:
+    """
+    读取一批图片的缩略图并缩小到 size，默认为 thumbnail_size，比最大一级还大时直接读取原图
+    先查找能满足 size 的最小一级：图集对应的一级只查图集，其余各级查缓存，之后再查 thumbnails 表，
+    每一步只有一次数据库操作；都没有的图片在子进程中并行生成全部各级，并在一个事务中写回
+    """
+    size = size or gallery_config.thumbnail_size
+    level = gallery_config.thumbnail_level_for(size)
+    if level is None:
+        return await load_thumbnails([image.get_image_path() for image in images], size)
+    thumbs: dict[int, Optional[Image.Image]] = {}
+    if thumbnail_atlas.enabled and level == thumbnail_atlas.tile:
+        # 图集本身就是这一级的缓存，不再经过 thumbnail_cache，缓存的未命中数只反映真正需要解码的图片
+        thumbs.update(await run_db(thumbnail_atlas.get_tiles, [image.id for image in images]))
+    else:
+        for image in images:
+            if (img := thumbnail_cache.get(image.id, level)) is not None:
+                thumbs[image.id] = img
+    misses = {image.id: image for image in images if image.id not in thumbs}
+    if misses:
+        for image_id, thumb_data in (await run_db(get_thumb_data_many, list(misses), level)).items():
+            thumbs[image_id] = misses.pop(image_id).decode_thumb_level(level, thumb_data)
+    if misses:
+        pyramids = await generate_thumbnails(list(misses.values()))
+        for image_id, image in misses.items():
+            pyramid = pyramids.get(image_id)
+            thumbs[image_id] = image.decode_thumb_level(level, pyramid[level]) if pyramid else None
+    for img in thumbs.values():
+        if img is not None:
+            img.thumbnail(size)
+    return [thumbs[image.id] for image in images]
+
+
+# 无法生成缩略图的图片，本次运行中不再重试
+_failed_thumbnail_ids: set[int] = set()
+
+
+async def generate_thumbnails(images: list[ImageMeta]) -> dict[int, dict[int, bytes]]:
+    """在子进程中并行生成一批缩略图，并在一个事务中写入，返回成功的 image_id -> 各级缩略图数据"""
+    paths = [str(image.get_image_path()) for image in images]
+    chunks = [paths[i:i + THUMBNAIL_TASK_SIZE] for i in range(0, len(paths), THUMBNAIL_TASK_SIZE)]
+    levels = gallery_config.thumbnail_levels
+    results = await asyncio.gather(*[_image_pool.submit(make_thumbnail_pyramids_data, chunk, levels)
+                                     for chunk in chunks])
+    pyramids = {}
+    for image, pyramid in zip(images, (pyramid for chunk in results for pyramid in chunk)):
+        if pyramid is None:
+            _failed_thumbnail_ids.add(image.id)
+            logger.warning(f'生成缩略图失败 {image.id}')
+        else:
+            pyramids[image.id] = pyramid
+    if pyramids:
+        await run_db(save_thumbnails, [(image_id, level, data) for image_id, pyramid in pyramids.items()
+                                       for level, data in pyramid.items()])
+    return pyramids
+
+
+async def generate_missing_thumbnails():
+    """
+    定时任务：清理过期的缩略图，并为缺少某一级缩略图的图片重新生成，修改尺寸配置后也由这里在后台重建
+    之后补齐并整理缩略图图集
+    """
+    if removed := await run_db(delete_stale_thumbnails):
+        logger.info(f'清理了 {removed} 张过期的缩略图')
+    last_id = 0
+    count = 0
+    while images := await run_db(get_images_without_thumbnails, last_id, THUMBNAIL_BATCH_SIZE):
+        last_id = images[-1].id
+        images = [image for image in images if image.id not in _failed_thumbnail_ids]
+        if images:
+            count += len(await generate_thumbnails(images))
+    if count > 0:
+        logger.info(f'预生成了 {count} 张缩略图')
+    count = 0
+    while filled := await run_db(fill_thumbnail_atlas, THUMBNAIL_BATCH_SIZE * 4):
+        count += filled
+    if count > 0:
+        logger.info(f'向缩略图图集补充了 {count} 张缩略图')
+    if moved := await run_db(thumbnail_atlas.compact):
+        logger.info(f'整理缩略图图集，搬动了 {moved} 个槽位')
+    logger.debug(f'缩略图缓存状态: {thumbnail_cache.stats()}')
+
+
+_pending_thumbnails: dict[int, ImageMeta] = {}
+_pending_task: Optional[asyncio.Task] = None
+
+
+def enqueue_thumbnail(image: ImageMeta):
+    """新图片入库后排队生成缩略图，同一轮事件循环中排队的图片合并为一批"""
+    global _pending_task
+    _pending_thumbnails[image.id] = image
+    if _pending_task is None or _pending_task.done():
+        _pending_task = asyncio.create_task(_flush_pending_thumbnails())
+
+
+async def _flush_pending_thumbnails():
+    await asyncio.sleep(0)
+    while _pending_thumbnails:
+        images = list(_pending_thumbnails.values())
+        _pending_thumbnails.clear()
+        try:
+            await generate_thumbnails(images)
+        except Exception as e:
+            logger.warning(f'生成缩略图失败: {e}')
@@ -1,4 +1,5 @@
-from typing import Tuple, List, Union
+import io
+from typing import Tuple, List, Dict, Union, Optional
 from collections import defaultdict
 from random import randrange
 from itertools import chain
@@ -343,3 +344,104 @@ def center_crop_by_aspect_ratio(img: Image.Image, aspect_ratio: float):
     bottom = top + target_height
     return img.crop((left, top, right, bottom))
 
+
+# ============================ 缩略图与格式探测 ============================ #
+# 以下函数都只接收路径等可序列化的参数，供 image_worker 在子进程中调用
+
+def open_image_reduced(image_path: Union[str, Path], min_size: Tuple[int, int], mode: Optional[str] = None) -> Image.Image:
+    """
+    以尽量低的分辨率读取图片，结果的宽高不小于 min_size（原图更小时保持原样）
+    JPEG 通过 draft() 让解码器直接输出 1/2、1/4、1/8 尺寸，其余格式解码后用 reduce() 做整数倍缩小，
+    之后再做精确的重采样就只需要处理很小的图
+    """
+    img = Image.open(image_path)
+    if img.format == 'JPEG':
+        img.draft(mode, min_size)
+    factor = min(img.width // min_size[0], img.height // min_size[1])
+    if factor >= 2:
+        source = img
+        if img.mode not in ('L', 'LA', 'RGB', 'RGBA', 'I', 'F'):
+            img = img.convert('RGBA' if mode is None else mode)
+        img = img.reduce(factor)
+        source.close()
+    return img
+
+
+def make_thumbnail(image_path: Union[str, Path], size: Tuple[int, int]) -> Image.Image:
+    """
+    读取图片并缩小到不超过 size
+    """
+    img = open_image_reduced(image_path, (size[0] * 2, size[1] * 2))
+    img.thumbnail(size)
+    return img
+
+
+def make_thumbnails(image_paths: List[Union[str, Path]], size: Tuple[int, int]) -> List[Optional[Image.Image]]:
+    """
+    批量生成缩略图，无法读取的图片对应 None
+    """
+    thumbnails = []
+    for image_path in image_paths:
+        try:
+            thumbnails.append(make_thumbnail(image_path, size))
+        except Exception:
+            thumbnails.append(None)
+    return thumbnails
+
+
+# 缩略图的生成方式 (格式、质量、缩放算法) 变化时加一，旧版本的缩略图会在后台重新生成
+THUMBNAIL_VERSION = 1
+
+
+def make_thumbnail_pyramid_data(image_path: Union[str, Path], levels: List[int]) -> Dict[int, bytes]:
+    """
+    只解码一次，生成多级缩略图并编码为 WebP，用于存入 thumbnails 表
+    level 是缩略图宽高的上限，从大到小依次在上一级的基础上缩小
+    """
+    levels = sorted(set(levels), reverse=True)
+    pyramid = {}
+    with open_image_reduced(image_path, (levels[0] * 2, levels[0] * 2)) as img:
+        img.thumbnail((levels[0], levels[0]))
+        img = img.convert('RGBA')
+        for level in levels:
+            img.thumbnail((level, level))
+            output_buffer = io.BytesIO()
+            img.save(output_buffer, format='WebP', optimize=True, quality=85)
+            pyramid[level] = output_buffer.getvalue()
+    return pyramid
+
+
+def make_thumbnail_pyramids_data(image_paths: List[Union[str, Path]], levels: List[int]) \
+        -> List[Optional[Dict[int, bytes]]]:
+    """
+    批量生成多级缩略图，无法读取的图片对应 None
+    """
+    pyramids = []
+    for image_path in image_paths:
+        try:
+            pyramids.append(make_thumbnail_pyramid_data(image_path, levels))
+        except Exception:
+            pyramids.append(None)
+    return pyramids
+
+
+_FORMAT_EXTS = {
+    "JPEG": ".jpg",
+    "PNG": ".png",
+    "GIF": ".gif",
+    "WEBP": ".webp",
+    "BMP": ".bmp",
+    "TIFF": ".tif",
+    "ICO": ".ico",
+}
+
+
+def probe_image_extension(image_path: Union[str, Path]) -> Optional[str]:
+    """
+    根据文件内容判断图片格式，返回扩展名（含点），不是图片时返回 None
+    """
+    try:
+        with Image.open(image_path) as img:
+            return _FORMAT_EXTS.get(img.format, f".{img.format.lower()}" if img.format else None)
+    except Exception:
+        return None
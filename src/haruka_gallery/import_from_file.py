@@ -10,12 +10,14 @@ fake_pkg_name = "haruka_gallery_script"
 
 pkg_dir = target.parent
 
+# 子进程 (spawn) 也会执行到这里，这样它们才能按包名找到 fingerprint 等模块
 pkg = ModuleType(fake_pkg_name)
 pkg.__path__ = [str(pkg_dir)]
 sys.modules[fake_pkg_name] = pkg
 
-spec = util.spec_from_file_location(f"{fake_pkg_name}.import_from_file", str(target))
-mod = importlib.util.module_from_spec(spec)
-sys.modules[spec.name] = mod
+if __name__ == "__main__":
+    spec = util.spec_from_file_location(f"{fake_pkg_name}.import_from_file", str(target))
+    mod = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = mod
 
-spec.loader.exec_module(mod)
\ No newline at end of file
+    spec.loader.exec_module(mod)
@@ -1,7 +1,18 @@
+import hashlib
+import multiprocessing as mp
+import os
 import sys
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
-from .gallery import gallery_manager
+from .config import gallery_config
+from .data import db
+from .fingerprint import try_compute_phash_from_path
+from .gallery import gallery_manager, PhashWrapper
+from .phash_index import fingerprint_matrix
+
+IMAGE_SUFFIXES = {'.gif', '.jpg', '.jpeg', '.png', '.bmp', '.webp'}
+CHUNK_SIZE = 200
 
 arg_offset = 1 if sys.argv[0].endswith('python.exe') or sys.argv[0].endswith('python3.exe') or sys.argv[0].endswith(
     'python') else 0
@@ -15,15 +26,51 @@ if not path.exists() or not path.is_dir():
     raise FileNotFoundError(f'Dir {path} does not exist.')
 with_comment = '--comment' in sys.argv
 is_force = '--force' in sys.argv
+is_restart = '--restart' in sys.argv
+
+# 断点文件：每提交一批就追加这一批处理过的相对路径，中断后重新运行会跳过它们
+path_digest = hashlib.sha1(str(path.resolve()).encode('utf-8')).hexdigest()[:12]
+checkpoint_path = gallery_config.data_dir / f"import_{gallery.id}_{path_digest}.checkpoint"
+done: set[str] = set()
+if checkpoint_path.exists():
+    if is_restart:
+        checkpoint_path.unlink()
+    else:
+        done = set(checkpoint_path.read_text(encoding='utf-8').splitlines())
+        print(f"从断点继续，已处理 {len(done)} 个文件")
+
+files = sorted(p for p in path.rglob('*') if p.is_file() and p.suffix.lower() in IMAGE_SUFFIXES)
+files = [p for p in files if str(p.relative_to(path)) not in done]
+total = len(files)
+print(f"共找到 {total} 个待处理的图片")
+
+added = 0
+skipped = 0
+failed = 0
+with ProcessPoolExecutor(max_workers=os.cpu_count(), mp_context=mp.get_context('spawn')) as executor:
+    phashes = executor.map(try_compute_phash_from_path, files, chunksize=16)
+    for start in range(0, total, CHUNK_SIZE):
+        chunk = files[start:start + CHUNK_SIZE]
+        with db:
+            for p in chunk:
+                value = next(phashes)
+                if value is None:
+                    failed += 1
+                    print("无法读取图片:", p)
+                    continue
+                phash = PhashWrapper(value)
+                # 同一批中先插入的图片已经进入索引，批内去重和库内去重是同一次查询
+                if not is_force and gallery.find_same_phash(phash):
+                    skipped += 1
+                    print("跳过相似的图片:", p)
+                    continue
+                comment = p.stem if with_comment else ""
+                gallery.add_image_unchecked(p, comment, [], "console", phash=phash, commit=False)
+                added += 1
+        with open(checkpoint_path, 'a', encoding='utf-8') as f:
+            f.writelines(str(p.relative_to(path)) + "\n" for p in chunk)
+        print(f"进度 {min(start + CHUNK_SIZE, total)}/{total}：已添加 {added}，跳过 {skipped}，失败 {failed}")
 
-for ext in ['*.gif', '*.jpg', '*.jpeg', '*.png', '*.bmp', '*.webp']:
-    for p in path.rglob(ext):
-        if not is_force and gallery.find_same_image(p):
-            print("跳过相似的图片:", p)
-            continue
-        comment = p.stem if with_comment else ""
-        gallery.add_image_unchecked(p, comment, [], "console")
-        if with_comment:
-            print("已添加图片及评论:", p.name)
-        else:
-            print("已添加图片:", p.name)
+fingerprint_matrix.flush()
+checkpoint_path.unlink(missing_ok=True)
+print(f"导入完成：已添加 {added}，跳过相似 {skipped}，无法读取 {failed}")
@@ -8,14 +8,24 @@ from nonebot.adapters.onebot.v11 import MessageSegment, Message, MessageEvent
 from nonebot.internal.matcher import Matcher
 
 from .config import gallery_config
+from .data import run_db
 from .gallery import ImageMeta
 
 
+async def _drop_missing_images(metas: list[ImageMeta]):
+    """清理本地文件已丢失的图片，drop 会修改数据库和内存索引，必须在数据库线程中执行"""
+    for meta in metas:
+        await run_db(meta.drop)
+    metas.clear()
+
+
 class MessageBuilder:
     def __init__(self):
         self.message = Message()
         self._reply_id: Optional[int] = None
         self._healing_map: list[Optional[ImageMeta]] = []
+        # image() 是同步的，文件丢失的图片先记下来，在 send 时清理
+        self._missing_images: list[ImageMeta] = []
         self.have_non_file_id_image = False
 
     def text(self, text: Optional[str], newline: bool = True):
@@ -53,7 +63,7 @@ class MessageBuilder:
             path_obj = Path(path_str)
             if not path_obj.exists():
                 logger.warning(f"图片文件不存在: {path_str}，已清理")
-                file.drop()
+                self._missing_images.append(file)
                 return self
 
             if not is_raw and file.file_id:
@@ -84,6 +94,7 @@ class MessageBuilder:
         return self
 
     async def send(self, matcher: Matcher, bot: Optional[Bot] = None):
+        await _drop_missing_images(self._missing_images)
         if not self.message and not self._reply_id:
             logger.warning("MessageBuilder: 消息为空，取消发送。")
             return
@@ -147,7 +158,7 @@ class MessageBuilder:
             new_seg: MessageSegment | None = None
             if not path_obj.exists():
                 logger.error(f"自愈失败：ImageMeta {meta.id} 本地文件已丢失: {path_str}")
-                meta.drop()
+                await run_db(meta.drop)
             elif meta.suffix == ".gif":
                 new_seg = MessageSegment.image(file=path_obj.read_bytes())
             else:
@@ -194,7 +205,7 @@ class MessageBuilder:
             new_file_id = sent_message.get("data").get('file')
 
             if meta and new_file_id:
-                meta.update_file_id(new_file_id)
+                await run_db(meta.update_file_id, new_file_id)
                 logger.info(f"ImageMeta {meta.id} 自愈成功, 更新 file_id: {new_file_id}")
             elif meta:
                 logger.warning(f"ImageMeta {meta.id} 自愈成功, 但未在回执中找到 new_file_id。")
@@ -205,8 +216,11 @@ class ForwardMessageBuilder:
 
     def __init__(self):
         self.nodes = []
+        self._missing_images: list[ImageMeta] = []
 
     def node(self, content: MessageBuilder, bot: Optional[Bot] = None):
+        self._missing_images.extend(content._missing_images)
+        content._missing_images.clear()
         actual_content = Message()
 
         for i, seg in enumerate(content.message):
@@ -246,6 +260,7 @@ class ForwardMessageBuilder:
         return self
 
     async def send(self, matcher: Matcher):
+        await _drop_missing_images(self._missing_images)
         message = Message()
         for node in self.nodes:
             message.append(node)
@@ -0,0 +1,303 @@
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from nonebot import logger
+
+from .config import gallery_config
+from .data import db, PHASH_MASK, on_external_change
+
+
+class PhashIndex:
+    """
+    64 位 pHash 的近重复索引 (multi-index hashing)
+
+    把哈希切成 threshold + 1 段，由抽屉原理，距离不超过 threshold 的两个哈希至少有一段完全相同，
+    所以只需要在每段的哈希表里取出候选再精确计算汉明距离，不必扫描整个画廊。
+    索引在第一次查询时从数据库加载，之后随图片的增删移动增量更新。
+    """
+    bits: int
+    threshold: int
+
+    def __init__(self, threshold: int = 5, bits: int = 64):
+        self.bits = bits
+        self.threshold = threshold
+        self._chunks = self._split_chunks(bits, threshold + 1)
+        self._tables: list[dict[int, set[int]]] = [{} for _ in self._chunks]
+        self._entries: dict[int, tuple[int, int]] = {}
+        self._loaded = False
+
+    @staticmethod
+    def _split_chunks(bits: int, count: int) -> list[tuple[int, int]]:
+        chunks = []
+        shift = 0
+        for i in range(count):
+            width = bits // count + (1 if i < bits % count else 0)
+            chunks.append((shift, (1 << width) - 1))
+            shift += width
+        return chunks
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        cursor = db.execute("select id, gallery_id, phash from images")
+        for image_id, gallery_id, phash in cursor:
+            self._insert(image_id, gallery_id, phash & PHASH_MASK)
+        self._loaded = True
+
+    def reset(self):
+        """丢弃索引，下次查询时重新从数据库加载"""
+        self._tables = [{} for _ in self._chunks]
+        self._entries = {}
+        self._loaded = False
+
+    def _insert(self, image_id: int, gallery_id: int, value: int):
+        self._entries[image_id] = (value, gallery_id)
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            table.setdefault((value >> shift) & mask, set()).add(image_id)
+
+    def add(self, image_id: int, gallery_id: int, value: int):
+        if not self._loaded:
+            return
+        self.remove(image_id)
+        self._insert(image_id, gallery_id, value)
+
+    def remove(self, image_id: int):
+        entry = self._entries.pop(image_id, None)
+        if entry is None:
+            return
+        value = entry[0]
+        for table, (shift, mask) in zip(self._tables, self._chunks):
+            key = (value >> shift) & mask
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(image_id)
+                if not bucket:
+                    del table[key]
+
+    def move(self, image_id: int, gallery_id: int):
+        entry = self._entries.get(image_id)
+        if entry is not None:
+            self._entries[image_id] = (entry[0], gallery_id)
+
+    def query(self, value: int, threshold: Optional[int] = None, gallery_id: Optional[int] = None) \
+            -> list[tuple[int, int]]:
+        """返回距离不超过 threshold 的 (image_id, distance)，按距离升序"""
+        self._ensure_loaded()
+        if threshold is None:
+            threshold = self.threshold
+        if threshold > self.threshold:
+            candidates = self._entries.keys()
+        else:
+            candidates = set()
+            for table, (shift, mask) in zip(self._tables, self._chunks):
+                bucket = table.get((value >> shift) & mask)
+                if bucket:
+                    candidates.update(bucket)
+        results = []
+        for image_id in candidates:
+            other, other_gallery_id = self._entries[image_id]
+            if gallery_id is not None and other_gallery_id != gallery_id:
+                continue
+            distance = (value ^ other).bit_count()
+            if distance <= threshold:
+                results.append((image_id, distance))
+        results.sort(key=lambda x: (x[1], x[0]))
+        return results
+
+
+class FingerprintMatrix:
+    """
+    全库 pHash 矩阵，用于跨画廊的相似度排序
+
+    phash / image_id / gallery_id 三列平行存放在内存映射的 .npy 文件中，一次 XOR + popcount 即可算出和所有图片的距离。
+    旁边的 json 记录已用槽位数和数据库签名 (图片数, 自增序号, sum(gallery_id * id))，加载时签名和数据库不一致就从数据库重建。
+    签名只在加载时检查，运行中其他进程改动数据库后由 reset 丢弃矩阵，下次查询时重新检查签名。
+    增删移动只修改内存映射，落盘和写 json 由 flush 定时批量完成；没来得及 flush 时签名对不上，下次启动会重建。
+    """
+    DTYPE = np.dtype([('phash', np.uint64), ('image_id', np.int64), ('gallery_id', np.int64)])
+    QUERY_BLOCK_CELLS = 1 << 24
+
+    def __init__(self, path: Path, initial_capacity: int = 1024):
+        self.path = path
+        self.meta_path = path.with_suffix('.json')
+        self.initial_capacity = initial_capacity
+        self._array: Optional[np.memmap] = None
+        self._size = 0
+        self._slots: dict[int, int] = {}
+        self._free_slots: list[int] = []
+        self._signature: Optional[list[int]] = None
+        self._dirty = False
+
+    @staticmethod
+    def _db_signature() -> list[int]:
+        count, checksum = db.execute("select count(*), coalesce(sum(gallery_id * id), 0) from images").fetchone()
+        row = db.execute("select seq from sqlite_sequence where name = 'images'").fetchone()
+        return [count, row[0] if row else 0, checksum]
+
+    def _ensure_loaded(self):
+        if self._array is not None:
+            return
+        signature = self._db_signature()
+        try:
+            meta = json.loads(self.meta_path.read_text(encoding='utf-8'))
+            if meta['signature'] != signature:
+                raise ValueError("fingerprint matrix is stale")
+            array = np.load(self.path, mmap_mode='r+')
+            if array.dtype != self.DTYPE:
+                raise ValueError("fingerprint matrix has unexpected dtype")
+            self._array = array
+            self._size = meta['size']
+            self._signature = signature
+            self._reindex()
+        except Exception:
+            self._rebuild(signature)
+
+    def reset(self):
+        self._array = None
+        self._dirty = False
+
+    def _reindex(self):
+        image_ids = self._array['image_id'][:self._size]
+        self._slots = {int(image_id): slot for slot, image_id in enumerate(image_ids) if image_id}
+        self._free_slots = [int(slot) for slot in np.flatnonzero(image_ids == 0)]
+
+    def _rebuild(self, signature: list[int]):
+        rows = db.execute("select id, gallery_id, phash from images order by id").fetchall()
+        self._write_file(max(self.initial_capacity, len(rows) * 2), rows)
+        self._size = len(rows)
+        self._signature = signature
+        self._reindex()
+        self._save_meta()
+
+    def _write_file(self, capacity: int, rows=None):
+        tmp_path = self.path.with_suffix('.tmp.npy')
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=self.DTYPE, shape=(capacity,))
+        if rows is not None:
+            for slot, (image_id, gallery_id, phash) in enumerate(rows):
+                array[slot] = (phash & PHASH_MASK, image_id, gallery_id)
+        elif self._array is not None:
+            array[:self._size] = self._array[:self._size]
+        array.flush()
+        del array
+        self._array = None
+        os.replace(tmp_path, self.path)
+        self._array = np.load(self.path, mmap_mode='r+')
+
+    def _save_meta(self):
+        self._array.flush()
+        self.meta_path.write_text(json.dumps({'size': self._size, 'signature': self._signature}), encoding='utf-8')
+        self._dirty = False
+
+    def flush(self):
+        """把增删移动落盘并写入 json，由定时任务和关闭时调用"""
+        if self._dirty and self._array is not None:
+            self._save_meta()
+
+    def add(self, image_id: int, gallery_id: int, value: int):
+        if self._array is None:
+            return
+        if self._free_slots:
+            slot = self._free_slots.pop()
+        else:
+            if self._size >= len(self._array):
+                self._write_file(len(self._array) * 2)
+            slot = self._size
+            self._size += 1
+        self._array[slot] = (value & PHASH_MASK, image_id, gallery_id)
+        self._slots[image_id] = slot
+        self._signature[0] += 1
+        self._signature[1] = max(self._signature[1], image_id)
+        self._signature[2] += gallery_id * image_id
+        self._dirty = True
+
+    def remove(self, image_id: int):
+        if self._array is None or (slot := self._slots.pop(image_id, None)) is None:
+            return
+        gallery_id = int(self._array[slot]['gallery_id'])
+        self._array[slot] = (0, 0, 0)
+        self._free_slots.append(slot)
+        self._signature[0] -= 1
+        self._signature[2] -= gallery_id * image_id
+        self._dirty = True
+
+    def move(self, image_id: int, gallery_id: int):
+        if self._array is None or (slot := self._slots.get(image_id)) is None:
+            return
+        old_gallery_id = int(self._array[slot]['gallery_id'])
+        self._array['gallery_id'][slot] = gallery_id
+        self._signature[2] += (gallery_id - old_gallery_id) * image_id
+        self._dirty = True
+
+    def _try_load(self) -> bool:
+        try:
+            self._ensure_loaded()
+            return True
+        except Exception as e:
+            logger.warning(f"无法加载 pHash 矩阵，改为在数据库中逐行比较: {e}")
+            return False
+
+    @staticmethod
+    def _query_sql(value: int, threshold: int, gallery_id: Optional[int] = None,
+                   limit: Optional[int] = None) -> list[tuple[int, int, int]]:
+        """矩阵文件无法读写时的后备方案，用 hamming() 在 images 表上全表扫描"""
+        sql = "select id, gallery_id, hamming(phash, ?) as distance from images where distance <= ?"
+        value &= PHASH_MASK
+        params: list = [value - (1 << 64) if value >= (1 << 63) else value, threshold]
+        if gallery_id is not None:
+            sql += " and gallery_id = ?"
+            params.append(gallery_id)
+        sql += " order by distance, id"
+        if limit is not None:
+            sql += " limit ?"
+            params.append(limit)
+        return db.execute(sql, params).fetchall()
+
+    def query(self, value: int, threshold: int = 5, gallery_id: Optional[int] = None,
+              limit: Optional[int] = None) -> list[tuple[int, int, int]]:
+        """返回距离不超过 threshold 的 (image_id, gallery_id, distance)，按距离升序"""
+        if not self._try_load():
+            return self._query_sql(value, threshold, gallery_id, limit)
+        array = self._array[:self._size]
+        distances = np.bitwise_count(array['phash'] ^ np.uint64(value & PHASH_MASK))
+        mask = (distances <= threshold) & (array['image_id'] != 0)
+        if gallery_id is not None:
+            mask &= array['gallery_id'] == gallery_id
+        slots = np.flatnonzero(mask)
+        order = np.lexsort((array['image_id'][slots], distances[slots]))
+        if limit is not None:
+            order = order[:limit]
+        slots = slots[order]
+        return [(int(image_id), int(gid), int(distance)) for image_id, gid, distance in
+                zip(array['image_id'][slots], array['gallery_id'][slots], distances[slots])]
+
+    def query_many(self, values: list[int], threshold: int = 5, limit: Optional[int] = None) \
+            -> list[list[tuple[int, int, int]]]:
+        """对每个 value 分别返回 query 的结果，多个哈希在同一次矩阵运算中比较"""
+        if not self._try_load():
+            return [self._query_sql(value, threshold, None, limit) for value in values]
+        array = self._array[:self._size]
+        valid = array['image_id'] != 0
+        # 每批的距离矩阵控制在 QUERY_BLOCK_CELLS 个元素以内
+        block = max(1, self.QUERY_BLOCK_CELLS // max(1, len(array)))
+        results = []
+        for start in range(0, len(values), block):
+            chunk = np.array([value & PHASH_MASK for value in values[start:start + block]], dtype=np.uint64)
+            distances = np.bitwise_count(array['phash'][None, :] ^ chunk[:, None])
+            for row in distances:
+                slots = np.flatnonzero((row <= threshold) & valid)
+                order = np.lexsort((array['image_id'][slots], row[slots]))
+                if limit is not None:
+                    order = order[:limit]
+                slots = slots[order]
+                results.append([(int(image_id), int(gid), int(distance)) for image_id, gid, distance in
+                                zip(array['image_id'][slots], array['gallery_id'][slots], row[slots])])
+        return results
+
+
+phash_index = PhashIndex()
+fingerprint_matrix = FingerprintMatrix(gallery_config.data_dir / "fingerprints.npy")
+on_external_change(phash_index.reset)
+on_external_change(fingerprint_matrix.reset)
@@ -0,0 +1,39 @@
+import random
+from collections import OrderedDict
+from typing import Callable, Hashable
+
+from .data import on_external_change
+
+
+class RandomSampler:
+    """
+    按筛选条件缓存符合条件的图片 id 列表，随机抽取只需 O(k)，不必每次 order by random() 排序全表
+
+    图片增删、移动或标签备注变化后需要调用 invalidate。
+    """
+
+    def __init__(self, max_filters: int = 128):
+        self.max_filters = max_filters
+        self._ids: OrderedDict[Hashable, list[int]] = OrderedDict()
+
+    def get_ids(self, key: Hashable, loader: Callable[[], list[int]]) -> list[int]:
+        ids = self._ids.get(key)
+        if ids is None:
+            ids = loader()
+            self._ids[key] = ids
+            while len(self._ids) > self.max_filters:
+                self._ids.popitem(last=False)
+        else:
+            self._ids.move_to_end(key)
+        return ids
+
+    def sample(self, key: Hashable, loader: Callable[[], list[int]], count: int) -> list[int]:
+        ids = self.get_ids(key, loader)
+        return random.sample(ids, min(count, len(ids)))
+
+    def invalidate(self):
+        self._ids.clear()
+
+
+random_sampler = RandomSampler()
+on_external_change(random_sampler.invalidate)
@@ -1,4 +1,4 @@
-create table aliases
+create table if not exists aliases
 (
     id      integer primary key autoincrement,
     name    text not null,
@@ -0,0 +1,14 @@
+alter table images
+    add column phash_int integer not null default 0;
+
+update images
+set phash_int = phash_from_hex(phash);
+
+alter table images
+    drop column phash;
+
+alter table images
+    rename column phash_int to phash;
+
+update meta
+set version = 5;
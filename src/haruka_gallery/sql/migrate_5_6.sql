@@ -0,0 +1,35 @@
+create virtual table images_fts using fts5
+(
+    comment,
+    content = 'images',
+    content_rowid = 'id',
+    tokenize = 'trigram'
+);
+
+insert into images_fts (images_fts)
+values ('rebuild');
+
+create trigger images_fts_after_insert
+    after insert
+    on images
+begin
+    insert into images_fts (rowid, comment) values (new.id, new.comment);
+end;
+
+create trigger images_fts_after_delete
+    after delete
+    on images
+begin
+    insert into images_fts (images_fts, rowid, comment) values ('delete', old.id, old.comment);
+end;
+
+create trigger images_fts_after_update
+    after update of comment
+    on images
+begin
+    insert into images_fts (images_fts, rowid, comment) values ('delete', old.id, old.comment);
+    insert into images_fts (rowid, comment) values (new.id, new.comment);
+end;
+
+update meta
+set version = 6;
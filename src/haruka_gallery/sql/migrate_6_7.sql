@@ -0,0 +1,5 @@
+create index if not exists idx_images_file_id
+    on images (file_id);
+
+update meta
+set version = 7;
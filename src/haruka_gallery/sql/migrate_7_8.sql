@@ -0,0 +1,18 @@
+drop index if exists idx_thumbnails_created_at;
+drop table thumbnails;
+
+create table thumbnails
+(
+    image_id   integer not null references images (id) on delete cascade,
+    size       integer not null,
+    version    integer not null,
+    data       blob    not null,
+    created_at timestamp default current_timestamp,
+    primary key (image_id, size, version)
+);
+
+create index idx_thumbnails_created_at
+    on thumbnails (created_at);
+
+update meta
+set version = 8;
@@ -0,0 +1,10 @@
+create table thumbnail_atlas
+(
+    image_id integer primary key references images (id) on delete cascade,
+    slot     integer not null unique,
+    width    integer not null,
+    height   integer not null
+);
+
+update meta
+set version = 9;
@@ -0,0 +1,95 @@
+from typing import Iterable, Optional
+
+import numpy as np
+
+from .data import db, on_external_change
+
+
+class TagIndex:
+    """
+    标签倒排索引
+
+    维护标签名到 id 的字典，以及每个标签下图片 id 的位图 (Python int 的第 n 位表示图片 n)，
+    多标签同时筛选就是位图按位与。第一次使用时从数据库加载，之后随标签修改和图片删除增量更新。
+    """
+
+    def __init__(self):
+        self._tag_ids: dict[str, int] = {}
+        self._postings: dict[int, int] = {}
+        self._image_tags: dict[int, set[int]] = {}
+        self._loaded = False
+
+    def _ensure_loaded(self):
+        if self._loaded:
+            return
+        for tag_id, name in db.execute("select id, name from tags"):
+            self._tag_ids[name] = tag_id
+        cursor = db.execute("""
+            select it.image_id, it.tag_id
+            from image_tags it
+                join images i on i.id = it.image_id
+            """)
+        for image_id, tag_id in cursor:
+            self._postings[tag_id] = self._postings.get(tag_id, 0) | (1 << image_id)
+            self._image_tags.setdefault(image_id, set()).add(tag_id)
+        self._loaded = True
+
+    def reset(self):
+        """丢弃索引，下次使用时重新从数据库加载"""
+        self._tag_ids = {}
+        self._postings = {}
+        self._image_tags = {}
+        self._loaded = False
+
+    def get_tag_id(self, name: str) -> Optional[int]:
+        self._ensure_loaded()
+        return self._tag_ids.get(name)
+
+    def add_tag(self, name: str, tag_id: int):
+        if self._loaded:
+            self._tag_ids[name] = tag_id
+
+    def set_image_tags(self, image_id: int, tag_ids: Iterable[int]):
+        if not self._loaded:
+            return
+        new_tag_ids = set(tag_ids)
+        old_tag_ids = self._image_tags.get(image_id, set())
+        bit = 1 << image_id
+        for tag_id in old_tag_ids - new_tag_ids:
+            self._postings[tag_id] &= ~bit
+        for tag_id in new_tag_ids - old_tag_ids:
+            self._postings[tag_id] = self._postings.get(tag_id, 0) | bit
+        if new_tag_ids:
+            self._image_tags[image_id] = new_tag_ids
+        else:
+            self._image_tags.pop(image_id, None)
+
+    def remove_image(self, image_id: int):
+        self.set_image_tags(image_id, ())
+
+    def intersect(self, tag_ids: list[int]) -> int:
+        """返回同时带有全部标签的图片位图"""
+        self._ensure_loaded()
+        postings = sorted((self._postings.get(tag_id, 0) for tag_id in set(tag_ids)), key=int.bit_length)
+        result = postings[0] if postings else 0
+        for posting in postings[1:]:
+            if not result:
+                break
+            result &= posting
+        return result
+
+    @staticmethod
+    def bitmap_to_ids(bitmap: int) -> list[int]:
+        # 转成小端字节后用 NumPy 展开，耗时只和位图长度有关，不会对每个置位做一次大整数运算
+        if not bitmap:
+            return []
+        data = np.frombuffer(bitmap.to_bytes((bitmap.bit_length() + 7) // 8, 'little'), dtype=np.uint8)
+        return np.flatnonzero(np.unpackbits(data, bitorder='little')).tolist()
+
+    def image_ids(self, tag_ids: list[int]) -> list[int]:
+        """同时带有全部标签的图片 id，升序"""
+        return self.bitmap_to_ids(self.intersect(tag_ids))
+
+
+tag_index = TagIndex()
+on_external_change(tag_index.reset)
@@ -1,6 +1,9 @@
 from apscheduler.triggers.interval import IntervalTrigger
-from nonebot import require, logger
+from nonebot import require, logger, get_driver
 
+from .data import run_db
+from .image_worker import generate_missing_thumbnails
+from .phash_index import fingerprint_matrix
 from .utils import file_cache, FileCache
 
 require("nonebot_plugin_apscheduler")
@@ -14,3 +17,25 @@ scheduler.add_job(
     id="haruka_gallery_file_cache_prune",
     replace_existing=True
 )
+
+scheduler.add_job(
+    generate_missing_thumbnails,
+    trigger=IntervalTrigger(minutes=10),
+    id="haruka_gallery_thumbnail_pregenerate",
+    replace_existing=True
+)
+
+
+async def flush_fingerprint_matrix():
+    await run_db(fingerprint_matrix.flush)
+
+
+scheduler.add_job(
+    flush_fingerprint_matrix,
+    trigger=IntervalTrigger(minutes=5),
+    id="haruka_gallery_fingerprint_flush",
+    replace_existing=True
+)
+
+get_driver().on_shutdown(file_cache.close)
+get_driver().on_shutdown(flush_fingerprint_matrix)
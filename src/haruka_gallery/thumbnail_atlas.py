@@ -0,0 +1,175 @@
+import heapq
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+from PIL import Image
+
+from .config import gallery_config
+from .data import db
+from .img_utils import THUMBNAIL_VERSION
+
+
+class ThumbnailAtlas:
+    """
+    固定槽位的缩略图图集，每个槽位是 tile x tile 的原始 RGBA 像素，整体存放在内存映射的 .npy 文件中
+
+    槽位索引 image_id -> (槽位, 宽, 高) 记录在数据库的 thumbnail_atlas 表中，缩略图贴在槽位的左上角。
+    一次取出多张缩略图只需要按槽位切片，不必逐行读取 BLOB 再解码 WebP。
+    删除图片只释放槽位，空槽位过多时由 compact 把后面的槽位搬进空洞并截短文件。
+    旁边的 json 记录槽位尺寸和缩略图版本，和当前配置不一致时清空重建。只在数据库线程中使用。
+    """
+    COMPACT_FREE_RATIO = 0.25
+
+    def __init__(self, path: Path, tile: int, enabled: bool = True, initial_capacity: int = 256):
+        self.path = path
+        self.meta_path = path.with_suffix('.json')
+        self.tile = tile
+        self.enabled = enabled
+        self.initial_capacity = initial_capacity
+        self._array: Optional[np.memmap] = None
+        self._size = 0
+        self._free_slots: list[int] = []
+
+    def __repr__(self):
+        return f"<ThumbnailAtlas tile={self.tile} size={self._size} free={len(self._free_slots)}>"
+
+    def _ensure_loaded(self):
+        if self._array is not None:
+            return
+        slots = [slot for slot, in db.execute("select slot from thumbnail_atlas order by slot")]
+        try:
+            meta = json.loads(self.meta_path.read_text(encoding='utf-8'))
+            if meta['tile'] != self.tile or meta['version'] != THUMBNAIL_VERSION:
+                raise ValueError("thumbnail atlas is stale")
+            array = np.load(self.path, mmap_mode='r+')
+            if array.dtype != np.uint8 or array.shape[1:] != (self.tile, self.tile, 4):
+                raise ValueError("thumbnail atlas has unexpected shape")
+            if slots and slots[-1] >= len(array):
+                raise ValueError("thumbnail atlas is truncated")
+            self._array = array
+        except Exception:
+            with db:
+                db.execute("delete from thumbnail_atlas")
+            slots = []
+            self._write_file(self.initial_capacity)
+            self.meta_path.write_text(json.dumps({'tile': self.tile, 'version': THUMBNAIL_VERSION}),
+                                      encoding='utf-8')
+        self._size = slots[-1] + 1 if slots else 0
+        used = set(slots)
+        self._free_slots = [slot for slot in range(self._size) if slot not in used]
+
+    def _write_file(self, capacity: int):
+        tmp_path = self.path.with_suffix('.tmp.npy')
+        array = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8,
+                                          shape=(capacity, self.tile, self.tile, 4))
+        if self._array is not None:
+            count = min(self._size, capacity)
+            array[:count] = self._array[:count]
+        array.flush()
+        del array
+        self._array = None
+        os.replace(tmp_path, self.path)
+        self._array = np.load(self.path, mmap_mode='r+')
+
+    def _allocate(self) -> int:
+        # 优先使用最靠前的空槽位，让占用的槽位尽量集中在文件前部
+        if self._free_slots:
+            return heapq.heappop(self._free_slots)
+        if self._size >= len(self._array):
+            self._write_file(len(self._array) * 2)
+        self._size += 1
+        return self._size - 1
+
+    def put_many(self, items: list[tuple[int, Image.Image]]):
+        """写入 (image_id, 缩略图)，超过槽位尺寸的会被缩小；已有槽位的图片原地覆盖"""
+        if not self.enabled or not items:
+            return
+        self._ensure_loaded()
+        rows = []
+        for image_id, img in dict(items).items():
+            if max(img.size) > self.tile:
+                img = img.copy()
+                img.thumbnail((self.tile, self.tile))
+            if img.mode != 'RGBA':
+                img = img.convert('RGBA')
+            row = db.execute("select slot from thumbnail_atlas where image_id = ?", (image_id,)).fetchone()
+            slot = row[0] if row else self._allocate()
+            self._array[slot] = 0
+            self._array[slot, :img.height, :img.width] = np.asarray(img)
+            rows.append((image_id, slot, img.width, img.height))
+        # 先落盘像素再提交索引，中途退出最多留下没有被引用的槽位
+        self._array.flush()
+        with db:
+            db.executemany("insert or replace into thumbnail_atlas values (?, ?, ?, ?)", rows)
+
+    def remove(self, image_id: int):
+        if not self.enabled:
+            return
+        self._ensure_loaded()
+        row = db.execute("select slot from thumbnail_atlas where image_id = ?", (image_id,)).fetchone()
+        if row is None:
+            return
+        with db:
+            db.execute("delete from thumbnail_atlas where image_id = ?", (image_id,))
+        heapq.heappush(self._free_slots, row[0])
+
+    def get_tiles(self, image_ids: list[int]) -> dict[int, Image.Image]:
+        """一次取出多张缩略图，图集中没有的不在返回结果中"""
+        if not self.enabled or not image_ids:
+            return {}
+        self._ensure_loaded()
+        rows = []
+        for i in range(0, len(image_ids), 500):
+            chunk = image_ids[i:i + 500]
+            rows.extend(db.execute(f"""
+                select image_id, slot, width, height from thumbnail_atlas
+                where image_id in ({', '.join(['?'] * len(chunk))})
+                """, chunk).fetchall())
+        if not rows:
+            return {}
+        tiles = self._array[np.array([slot for _, slot, _, _ in rows])]
+        return {image_id: Image.fromarray(np.ascontiguousarray(tile[:height, :width]))
+                for tile, (image_id, _, width, height) in zip(tiles, rows)}
+
+    def compact(self, force: bool = False) -> int:
+        """
+        删除图片已不存在的槽位，空槽位超过 COMPACT_FREE_RATIO 时把末尾的槽位搬进前面的空洞并截短文件
+        返回搬动的槽位数
+        """
+        if not self.enabled:
+            return 0
+        self._ensure_loaded()
+        with db:
+            db.execute("delete from thumbnail_atlas where image_id not in (select id from images)")
+        rows = db.execute("select image_id, slot from thumbnail_atlas order by slot").fetchall()
+        if not force and self._size - len(rows) <= self._size * self.COMPACT_FREE_RATIO:
+            used = {slot for _, slot in rows}
+            self._free_slots = [slot for slot in range(self._size) if slot not in used]
+            return 0
+        # 只把前 len(rows) 个槽位之外的图片搬进这个范围内原本空着的槽位，不覆盖任何仍被索引引用的槽位，
+        # 所以提交索引之前中途退出，旧索引指向的像素仍然完整
+        size = len(rows)
+        used = {slot for _, slot in rows}
+        holes = [slot for slot in range(size) if slot not in used]
+        tail = [(image_id, slot) for image_id, slot in rows if slot >= size]
+        moves = []
+        for target, (image_id, slot) in zip(holes, tail):
+            self._array[target] = self._array[slot]
+            moves.append((target, image_id))
+        self._array.flush()
+        with db:
+            db.executemany("update thumbnail_atlas set slot = ? where image_id = ?", moves)
+        self._size = size
+        self._free_slots = []
+        capacity = max(self.initial_capacity, self._size * 2)
+        if len(self._array) > capacity:
+            self._write_file(capacity)
+        return len(moves)
+
+
+thumbnail_atlas = ThumbnailAtlas(gallery_config.data_dir / "thumbnail_atlas.npy",
+                                 gallery_config.thumbnail_level_for(gallery_config.thumbnail_size),
+                                 gallery_config.thumbnail_atlas)
@@ -0,0 +1,81 @@
+import threading
+from collections import OrderedDict
+from typing import Optional
+
+from PIL import Image
+
+from .config import gallery_config
+from .img_utils import THUMBNAIL_VERSION
+
+
+class ThumbnailCache:
+    """
+    已解码缩略图的 LRU 缓存，按图片占用的字节数限制总大小，事件循环和数据库线程都会使用，所以加锁
+
+    键为 (image_id, 尺寸, 缩略图版本)。get 返回副本，调用方可以随意修改；put 之后不要再修改传入的图片。
+    图片被删除或缩略图重新生成后需要调用 invalidate。hits / misses 用于评估缓存大小是否合适。
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._bytes = 0
+        self._images: OrderedDict[tuple[int, int, int], Image.Image] = OrderedDict()
+        self._levels: dict[int, set[int]] = {}
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return (f"<ThumbnailCache entries={len(self._images)} bytes={self._bytes}/{self.max_bytes} "
+                f"hits={self.hits} misses={self.misses}>")
+
+    @staticmethod
+    def _size_of(img: Image.Image) -> int:
+        return img.width * img.height * len(img.getbands())
+
+    def get(self, image_id: int, level: int) -> Optional[Image.Image]:
+        key = (image_id, level, THUMBNAIL_VERSION)
+        with self._lock:
+            img = self._images.get(key)
+            if img is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._images.move_to_end(key)
+        return img.copy()
+
+    def put(self, image_id: int, level: int, img: Image.Image):
+        key = (image_id, level, THUMBNAIL_VERSION)
+        size = self._size_of(img)
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if (old := self._images.pop(key, None)) is not None:
+                self._bytes -= self._size_of(old)
+            self._images[key] = img
+            self._levels.setdefault(image_id, set()).add(level)
+            self._bytes += size
+            while self._bytes > self.max_bytes:
+                (old_id, old_level, _), old = self._images.popitem(last=False)
+                self._bytes -= self._size_of(old)
+                self._discard_level(old_id, old_level)
+
+    def _discard_level(self, image_id: int, level: int):
+        levels = self._levels.get(image_id)
+        if levels is not None:
+            levels.discard(level)
+            if not levels:
+                del self._levels[image_id]
+
+    def invalidate(self, image_id: int):
+        with self._lock:
+            for level in self._levels.pop(image_id, ()):
+                if (old := self._images.pop((image_id, level, THUMBNAIL_VERSION), None)) is not None:
+                    self._bytes -= self._size_of(old)
+
+    def stats(self) -> dict[str, int]:
+        return {'entries': len(self._images), 'bytes': self._bytes, 'max_bytes': self.max_bytes,
+                'hits': self.hits, 'misses': self.misses}
+
+
+thumbnail_cache = ThumbnailCache(gallery_config.thumbnail_cache_mb * 1024 * 1024)
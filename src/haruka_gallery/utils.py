@@ -1,7 +1,10 @@
 import asyncio
+import hashlib
 import json
 import mimetypes
 import os
+import time
+from collections import OrderedDict
 from datetime import datetime
 from pathlib import Path
 from typing import Optional, Tuple, List
@@ -11,6 +14,9 @@ from nonebot import get_bot, logger
 from nonebot.adapters.onebot.v11 import MessageEvent
 
 from .config import gallery_config
+from .download_index import download_index, normalize_download_key, run_index
+from .fingerprint import fingerprint_cache, sha256_of_file
+from .image_worker import compute_phash, probe_extension
 
 COMMON_IMAGE_EXTS = {
     "image/jpeg": ".jpg",
@@ -33,6 +39,8 @@ class CachedFile:
     created_at: datetime
     extra: dict
     timeout: int
+    sha256: Optional[str]
+    phash: Optional[int]
 
     def __init__(self, url: str, local_path: str, timeout: int = 3600):
         self.url = url
@@ -41,6 +49,8 @@ class CachedFile:
         self.created_at = datetime.now()
         self.extra = {}
         self.timeout = timeout
+        self.sha256 = None
+        self.phash = None
 
     def __repr__(self):
         return f"<CachedFile url={self.url} local_path={self.local_path} used={self.used} created_at={self.created_at} extra={self.extra} timeout={self.timeout}>"
@@ -66,12 +76,37 @@ class CachedFile:
         self.timeout = timeout
         return self
 
+    async def ensure_fingerprint(self) -> Optional[int]:
+        """返回文件的 pHash，同一内容只计算一次；不是图片时返回 None"""
+        if self.sha256 is None:
+            self.sha256 = await asyncio.to_thread(sha256_of_file, self.local_path)
+        if self.phash is None:
+            if self.sha256 in fingerprint_cache:
+                self.phash = fingerprint_cache.get(self.sha256)
+            else:
+                self.phash = await compute_phash(self.local_path)
+                fingerprint_cache.put(self.sha256, self.phash)
+        return self.phash
+
+
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+DOWNLOAD_RETRY_BACKOFF = 0.5
+RETRYABLE_STATUS = {408, 429, 500, 502, 503, 504}
+
+
+class _TransientDownloadError(Exception):
+    pass
+
 
 class FileCache:
     files: dict[str, CachedFile]
 
     def __init__(self):
         self.files = {}
+        self._session: Optional[aiohttp.ClientSession] = None
+        self._inflight: dict[str, asyncio.Task[CachedFile]] = {}
+        self._download_semaphore = asyncio.Semaphore(gallery_config.download_concurrency)
+        self._orphans_swept = False
         if not os.path.exists(gallery_config.cache_dir):
             os.makedirs(gallery_config.cache_dir)
 
@@ -122,82 +157,239 @@ class FileCache:
                 count += 1
         return count
 
-    async def download(self, url: str, extra: dict | None = None) -> CachedFile:
-        if url in self.files:
-            return self.files[url].renewed().update_extra(extra)
-
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, verify_ssl=False) as resp:
-                if resp.status != 200:
-                    raise Exception(f"下载文件 {os.truncate(url, 32)} 失败: {resp.status} {resp.reason}")
-                content_type = resp.headers.get("Content-Type", "")
-                ext = self._extension_from_content_type(content_type)
-                filename = self._random_filename(ext)
-                filepath = os.path.join(gallery_config.cache_dir, filename)
-                file = CachedFile(url, filepath)
-                self.files[url] = file
+    def _get_session(self) -> aiohttp.ClientSession:
+        """所有下载共用一个带连接池的会话，第一次下载时创建"""
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=gallery_config.download_concurrency,
+                                             limit_per_host=gallery_config.download_per_host_limit,
+                                             ssl=False)
+            timeout = aiohttp.ClientTimeout(total=gallery_config.download_timeout, sock_connect=10)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=timeout)
+        return self._session
+
+    async def close(self):
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
+
+    async def _fetch(self, url: str) -> CachedFile:
+        """流式写入缓存目录，超过 size_limit_mb 立即中止；可重试的失败抛出 _TransientDownloadError"""
+        size_limit = gallery_config.size_limit_mb * 1024 * 1024
+        async with self._get_session().get(url) as resp:
+            if resp.status in RETRYABLE_STATUS:
+                raise _TransientDownloadError(f"{resp.status} {resp.reason}")
+            if resp.status != 200:
+                raise Exception(f"下载文件 {url[:32]} 失败: {resp.status} {resp.reason}")
+            if resp.content_length is not None and resp.content_length > size_limit:
+                raise Exception(f"下载文件 {url[:32]} 失败: 文件大小超过 {gallery_config.size_limit_mb}MB")
+            ext = self._extension_from_content_type(resp.headers.get("Content-Type", ""))
+            filepath = os.path.join(gallery_config.cache_dir, self._random_filename(ext))
+            sha256 = hashlib.sha256()
+            size = 0
+            try:
                 with open(filepath, "wb") as f:
-                    f.write(await resp.read())
-                return file.update_extra(extra)
+                    async for chunk in resp.content.iter_chunked(DOWNLOAD_CHUNK_SIZE):
+                        size += len(chunk)
+                        if size > size_limit:
+                            raise Exception(f"下载文件 {url[:32]} 失败: 文件大小超过 {gallery_config.size_limit_mb}MB")
+                        sha256.update(chunk)
+                        f.write(chunk)
+            except BaseException:
+                if os.path.exists(filepath):
+                    os.remove(filepath)
+                raise
+        file = CachedFile(url, filepath)
+        file.sha256 = sha256.hexdigest()
+        if not ext and (probed_ext := await probe_extension(filepath)):
+            os.replace(filepath, filepath + probed_ext)
+            file.local_path = filepath + probed_ext
+        return file
 
-    async def prune(self):
-        current_time = datetime.now()
-        self.files = {url: file for url, file in self.files.items() if
-                      not file.used or (current_time - file.created_at).total_seconds() < file.timeout}
-        keep_files = {file.local_path for file in self.files.values()}
-        for filename in os.listdir(gallery_config.cache_dir):
-            filepath = os.path.join(gallery_config.cache_dir, filename)
-            if filepath not in keep_files:
+    async def _load_indexed(self, key: str, url: str) -> Optional[CachedFile]:
+        """从持久化索引中恢复之前下载过的文件，文件已被删除时清理索引"""
+        entry = await run_index(download_index.get, key)
+        if entry is None:
+            return None
+        filepath = os.path.join(gallery_config.cache_dir, entry.filename)
+        if not os.path.exists(filepath):
+            await run_index(download_index.remove, key)
+            return None
+        file = CachedFile(url, filepath)
+        file.sha256 = entry.sha256
+        file.phash = entry.phash
+        if entry.sha256 is not None:
+            fingerprint_cache.put(entry.sha256, entry.phash)
+        self.files[key] = file
+        return file
+
+    async def download(self, url: str, extra: dict | None = None) -> CachedFile:
+        key = normalize_download_key(url, extra.get("file_id") if extra else None)
+        if key in self.files:
+            return self.files[key].renewed().update_extra(extra)
+        if (file := await self._load_indexed(key, url)) is not None:
+            return file.update_extra(extra)
+        # 查询清单期间可能已有其他调用方下载完成
+        if key in self.files:
+            return self.files[key].renewed().update_extra(extra)
+
+        # 同一张图片正在下载时直接等待那一次传输，不重复下载
+        task = self._inflight.get(key)
+        if task is None:
+            task = asyncio.create_task(self._download(key, url))
+            self._inflight[key] = task
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # shield: 某个调用方被取消时不影响其他等待同一次传输的调用方
+        file = await asyncio.shield(task)
+        return file.update_extra(extra)
+
+    async def _download(self, key: str, url: str) -> CachedFile:
+        retries = gallery_config.download_retries
+        async with self._download_semaphore:
+            for attempt in range(retries + 1):
                 try:
-                    os.remove(filepath)
-                    logger.debug(f"Removed cached file: {filepath}")
-                except Exception as e:
-                    logger.warning(f"Failed to remove cached file {filepath}: {e}")
+                    file = await self._fetch(url)
+                    break
+                except (_TransientDownloadError, aiohttp.ClientError, asyncio.TimeoutError) as e:
+                    reason = str(e) or type(e).__name__
+                    if attempt >= retries:
+                        raise Exception(f"下载文件 {url[:32]} 失败: {reason}") from e
+                    delay = DOWNLOAD_RETRY_BACKOFF * (2 ** attempt)
+                    logger.warning(f"下载文件 {url[:32]} 失败 ({reason})，{delay:.1f} 秒后重试")
+                    await asyncio.sleep(delay)
+        await file.ensure_fingerprint()
+        self.files[key] = file
+        await run_index(download_index.put, key, file.path.name, os.path.getsize(file.local_path), file.sha256,
+                        file.phash)
+        return file
 
+    @staticmethod
+    def _remove_file(filepath: str):
+        try:
+            os.remove(filepath)
+            logger.debug(f"Removed cached file: {filepath}")
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            logger.warning(f"Failed to remove cached file {filepath}: {e}")
+
+    def _sweep_orphans(self, keep_files: set[str]):
+        """删除 keep_files 以外的文件 (旧版本留下的或下载中途退出的)，只在启动后第一次清理时执行"""
+        deadline = time.time() - gallery_config.download_timeout
+        for entry in os.scandir(gallery_config.cache_dir):
+            if entry.is_file() and entry.name not in keep_files and entry.stat().st_mtime < deadline:
+                self._remove_file(entry.path)
+
+    async def prune(self):
+        if not self._orphans_swept:
+            keep_files = await run_index(download_index.filenames) | {file.path.name for file in self.files.values()}
+            await asyncio.to_thread(self._sweep_orphans, keep_files)
+            self._orphans_swept = True
+
+        # 内存中命中的访问时间写回清单，再按 LRU 淘汰到预算以内
+        accesses = [(key, file.created_at.timestamp()) for key, file in self.files.items()]
+        await run_index(download_index.touch, accesses)
+        for key, filename in await run_index(download_index.evict, gallery_config.cache_size_limit_mb * 1024 * 1024):
+            self.files.pop(key, None)
+            self._remove_file(os.path.join(gallery_config.cache_dir, filename))
+
+        # 其余内存条目按各自的 timeout 过期，不在清单中的文件 (new_file 创建的) 随之删除
+        indexed_files = await run_index(download_index.filenames)
+        current_time = datetime.now()
+        for key, file in list(self.files.items()):
+            if file.used and (current_time - file.created_at).total_seconds() >= file.timeout:
+                del self.files[key]
+                if file.path.name not in indexed_files:
+                    self._remove_file(file.local_path)
 
 file_cache = FileCache()
 
 
-async def get_images_from_context(event: MessageEvent):
+# 合并转发的解析限制：最大嵌套层数、最多收集的图片数、同时请求 get_forward_msg 的数量
+FORWARD_MAX_DEPTH = 3
+FORWARD_IMAGE_LIMIT = 100
+FORWARD_FETCH_CONCURRENCY = 4
+# get_forward_msg 结果的缓存时间 (秒) 和条数
+FORWARD_CACHE_TTL = 300
+FORWARD_CACHE_SIZE = 256
+
+_forward_cache: OrderedDict[str, tuple[float, list]] = OrderedDict()
+_forward_semaphore = asyncio.Semaphore(FORWARD_FETCH_CONCURRENCY)
+
+
+async def get_forward_segments(bot, forward_id: str) -> list:
+    """合并转发中所有消息段，同一个转发在 FORWARD_CACHE_TTL 内只请求一次"""
+    cached = _forward_cache.get(forward_id)
+    if cached is not None and time.monotonic() - cached[0] < FORWARD_CACHE_TTL:
+        _forward_cache.move_to_end(forward_id)
+        return cached[1]
+    async with _forward_semaphore:
+        result = await bot.call_api('get_forward_msg', **{'id': forward_id})
+    segments = [seg for item in result['messages'] for seg in item['message']]
+    _forward_cache[forward_id] = (time.monotonic(), segments)
+    _forward_cache.move_to_end(forward_id)
+    while len(_forward_cache) > FORWARD_CACHE_SIZE:
+        _forward_cache.popitem(last=False)
+    return segments
+
+
+async def get_images_from_context(event: MessageEvent) -> Tuple[list[Tuple[str, Optional[str]]], Optional[str]]:
+    """
+    收集消息、引用消息和合并转发中图片的 (url, file_id)，最多 FORWARD_IMAGE_LIMIT 张
+    第二个返回值在因为超过图片数或嵌套层数上限丢弃了图片时说明原因，调用方应当告知用户，否则为 None
+    """
     images: list[Tuple[str, Optional[str]]] = []
+    truncated: Optional[str] = None
     messages = [msg for msg in event.message]
     bot = get_bot()
     if event.reply:
         messages.extend(event.reply.message)
-    while len(messages) > 0:
-        seg = messages.pop(0)
-        message_type = seg["type"] if isinstance(seg, dict) and seg.get("type") else seg.type
-        message_data = seg["data"] if isinstance(seg, dict) and seg.get("data") else seg.data
-
-        if message_type == "image":
-            images.append((message_data['url'], message_data.get('file')))
-        elif message_type == 'mface':
-            if 'url' in message_data:
+    # 逐层展开合并转发，同一层的转发并发获取，下一层按原顺序拼接
+    for depth in range(FORWARD_MAX_DEPTH + 1):
+        nested: list[list | str] = []
+        for seg in messages:
+            message_type = seg["type"] if isinstance(seg, dict) and seg.get("type") else seg.type
+            message_data = seg["data"] if isinstance(seg, dict) and seg.get("data") else seg.data
+
+            if message_type == "image":
                 images.append((message_data['url'], message_data.get('file')))
-        elif message_type == "forward":
-            if content := message_data.get("content"):
-                if isinstance(content, list):
-                    for item in content:
-                        messages.extend(item.get("message", []))
-                    continue
-            result = await bot.call_api('get_forward_msg', **{'id': str(message_data['id'])})
-            for item in result['messages']:
-                messages.extend(item['message'])
-        elif message_type == "json":
-            try:
-                json_data = json.loads(message_data["data"])
-
-                if json_data.get("app") == "com.tencent.multimsg":
-                    forward_id = json_data.get("meta", {}).get("detail", {}).get("resid")
-                    if forward_id:
-                        result = await bot.call_api('get_forward_msg', **{'id': str(forward_id)})
-                        for item in result['messages']:
-                            messages.extend(item['message'])
+            elif message_type == 'mface':
+                if 'url' in message_data:
+                    images.append((message_data['url'], message_data.get('file')))
+            elif message_type == "forward":
+                if content := message_data.get("content"):
+                    if isinstance(content, list):
+                        nested.append([seg for item in content for seg in item.get("message", [])])
+                        continue
+                nested.append(str(message_data['id']))
+            elif message_type == "json":
+                try:
+                    json_data = json.loads(message_data["data"])
 
-            except Exception as e:
-                logger.warning(f"解析 JSON 消息段失败: {e}")
+                    if json_data.get("app") == "com.tencent.multimsg":
+                        forward_id = json_data.get("meta", {}).get("detail", {}).get("resid")
+                        if forward_id:
+                            nested.append(str(forward_id))
 
-    return images
+                except Exception as e:
+                    logger.warning(f"解析 JSON 消息段失败: {e}")
+
+        if len(images) >= FORWARD_IMAGE_LIMIT:
+            # 达到上限后不再展开剩下的合并转发，它们里面可能还有图片
+            if len(images) > FORWARD_IMAGE_LIMIT or nested:
+                truncated = f"图片超过 {FORWARD_IMAGE_LIMIT} 张，只处理了前 {FORWARD_IMAGE_LIMIT} 张，其余图片已忽略。"
+            break
+        if not nested:
+            break
+        if depth == FORWARD_MAX_DEPTH:
+            truncated = f"合并转发嵌套超过 {FORWARD_MAX_DEPTH} 层，更深的图片已忽略。"
+            break
+        fetched = iter(await asyncio.gather(*(get_forward_segments(bot, item) for item in nested
+                                               if isinstance(item, str))))
+        messages = [seg for item in nested for seg in (next(fetched) if isinstance(item, str) else item)]
+
+    if truncated:
+        logger.warning(truncated)
+    return images[:FORWARD_IMAGE_LIMIT], truncated
 
 
 async def download_images(image_urls: list[str | Tuple[str, Optional[str]]]) -> list[CachedFile]: